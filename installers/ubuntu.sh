@@ -19,3 +19,6 @@ sudo apt-get install gir1.2-gexiv2-0.10 python3-gi libgirepository1.0-dev
 #sudo apt-get update
 sudo apt-get install handbrake-cli
 
+# ffmpeg for video posters and contact sheets (--posters)
+sudo apt-get install -y ffmpeg
+
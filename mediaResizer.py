@@ -7,6 +7,7 @@ Program to process images and videos to desired format, resolution, and size.
 
 Usage:
     mediaResizer [options] <folder>
+    mediaResizer --plan [options] <folder>
     mediaResizer -h | --help
     mediaResizer --version
 
@@ -16,18 +17,132 @@ Options:
     -q              Quiet the logging to only ERROR level.
     -v              Verbose output (INFO level).
     --debug         Very Verbose output (DEBUG level).
+    --no-color-management
+                    Don't convert photos to sRGB, keep the source colours.
+    --intent=<intent>
+                    Rendering intent for the sRGB conversion, one of
+                    perceptual, relative, saturation or absolute
+                    [default: perceptual].
+    --max-memory=<mb>
+                    Photos bigger than this once decoded are resized in
+                    bands, keeping each worker under this many megabytes
+                    [default: 512].  Only PNGs and uncompressed TIFFs can be
+                    read in bands, compressed TIFFs and other formats are
+                    still decoded whole.
+    --plan          Only estimate the time and disk space a run would take.
+    --workers=<n>   Number of photo worker processes, defaults to the number
+                    of cores less two.
+    --costs=<file>  Where timings from previous runs are kept to calibrate
+                    the estimates [default: ~/.config/mediaResizer/costs.json].
+    --profile       Profile the main process and every worker, and record the
+                    resources used by each HandBrake run.  Reports are written
+                    to a profile_<size> folder next to resized_<size>.
+    --cache=<dir>   Keep every rendition in this content addressed cache and
+                    reuse it for identical sources in any folder.
+    --cache-size=<mb>
+                    Disk budget of the rendition cache, least recently used
+                    renditions are evicted past it [default: 10240].
+    --distributed   Share the work with other hosts running on the same
+                    folder through a job queue in resized_<size>.
+    --lease=<seconds>
+                    How long a host may go without a heartbeat before its
+                    distributed jobs are handed to another [default: 300].
+    --upload=<url>  Send every finished rendition to a directory, an
+                    sftp://user@host/path or an http(s):// WebDAV/PUT url.
+    --upload-jobs=<n>
+                    Concurrent uploads, each keeping its connection open
+                    [default: 4].
+    --upload-retries=<n>
+                    Attempts per file before giving up [default: 3].
+    --archive=<format>
+                    Write the photos into one uncompressed tar or zip per
+                    folder, with a JSON index of member offsets, instead of
+                    separate files.  EXIF is copied by Pillow in this mode.
+    --previews      Resize from the camera's embedded EXIF/MPF preview when it
+                    is at least as big as the rendition, skipping the full
+                    decode.  Good for thumbnails.
+    --resync        Only rewrite the EXIF, IPTC and XMP of existing photo
+                    outputs whose source changed nothing but its metadata.
+                    Photos with changed pixels are resized again as usual.
+    --disk-order    Process files in the order they sit on disk instead of
+                    directory order, to cut seeking on spinning disks.
+    --readahead=<n>
+                    Ask the kernel to read the n photos after the ones the
+                    workers have taken into the page cache, and drop the
+                    finished ones from it [default: 0].
+    --target-size=<kb>
+                    Use the highest JPEG quality that keeps each photo under
+                    this many kilobytes.
+    --target-ssim=<ssim>
+                    Use the lowest JPEG quality whose SSIM against the
+                    resized photo reaches this, e.g. 0.95.  When a target
+                    size is given too, the smaller of the two qualities wins.
+    --report=<file> Write a record of every job and a summary of the run to
+                    this .json, .csv or .sqlite file.  Defaults to
+                    report.json in resized_<size>.
+    --retries=<n>   Extra attempts for jobs that failed for a reason that
+                    may go away, like a busy or stale NAS [default: 1].
+    --posters       Also make a poster JPEG and a contact sheet for every
+                    video, with ffmpeg running alongside HandBrake.
+    --sheet=<grid>  Columns and rows of the contact sheet [default: 4x3].
+    --autoscale     Run photos and videos side by side and grow or shrink the
+                    photo workers and concurrent videos with the load, io
+                    and memory pressure.  --workers is where it starts.
+    --min-workers=<n>
+                    Fewest photo workers when autoscaling [default: 1].
+    --max-workers=<n>
+                    Most photo workers when autoscaling, defaults to the
+                    number of cores.
+    --max-videos=<n>
+                    Most concurrent videos when autoscaling [default: 2].
+    --scale-interval=<seconds>
+                    Time between autoscaling decisions [default: 5].
 """
+import base64
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import cProfile
+import fcntl
 from docopt import docopt
+import errno
+import hashlib
+import http.client
+import io
+import json
 import logging
 import magic
+import math
+import mmap
 import os
+import posixpath
+from queue import Empty, SimpleQueue
+import pstats
 import psutil
-from PIL import Image
+import random
+from pymediainfo import MediaInfo
+from PIL import Image, ImageCms, ImageMath
 import gi
 gi.require_version('GExiv2', '0.10')
+from gi.repository import GLib
 from gi.repository.GExiv2 import Metadata
+import shutil
+import socket
+import sqlite3
+import struct
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlsplit
+import zipfile
+import zlib
 from multiprocessing import Pool, cpu_count, Queue, Process
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
 
 
 def limit_cpu():
@@ -38,8 +153,1630 @@ def limit_cpu():
     p.nice(19)
 
 
+RENDERING_INTENTS = {
+    'perceptual': ImageCms.Intent.PERCEPTUAL,
+    'relative': ImageCms.Intent.RELATIVE_COLORIMETRIC,
+    'saturation': ImageCms.Intent.SATURATION,
+    'absolute': ImageCms.Intent.ABSOLUTE_COLORIMETRIC,
+}
+
+# Per worker process state for colour management.  Each Pool worker builds
+# its own transforms, they can't be shared between processes.
+_TRANSFORM_CACHE_SIZE = 16
+_transform_cache = OrderedDict()
+_srgb_profile = None
+
+
+def srgb_profile():
+    "Returns the sRGB profile, creating it once per process."
+    global _srgb_profile
+    if _srgb_profile is None:
+        _srgb_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB'))
+    return _srgb_profile
+
+
+def _is_srgb(profile):
+    description = ImageCms.getProfileDescription(profile) or ''
+    return 'srgb' in description.lower()
+
+
+def get_srgb_transform(icc_profile, mode, intent):
+    """
+    Returns a transform from the embedded profile to sRGB, or None when the
+    profile already is sRGB.  Transforms are kept in a small LRU cache keyed
+    by the profile hash, image mode and rendering intent since building one
+    is far slower than applying it.
+
+    :param icc_profile: Raw ICC profile bytes from the source image.
+    :param mode: Pillow mode of the image, 'RGB' or 'CMYK'.
+    :param intent: One of the ImageCms.Intent values.
+    """
+    key = (hashlib.sha1(icc_profile).digest(), mode, intent)
+    if key in _transform_cache:
+        _transform_cache.move_to_end(key)
+        return _transform_cache[key]
+    source = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    if mode == 'RGB' and _is_srgb(source):
+        transform = None
+    else:
+        transform = ImageCms.buildTransform(source, srgb_profile(), mode,
+                                            'RGB', intent)
+    _transform_cache[key] = transform
+    if len(_transform_cache) > _TRANSFORM_CACHE_SIZE:
+        _transform_cache.popitem(last=False)
+    return transform
+
+
+def convert_to_srgb(im, intent=ImageCms.Intent.PERCEPTUAL):
+    """
+    Converts an image to sRGB using its embedded ICC profile.  Images without
+    a profile are assumed to be sRGB already and are returned untouched, as
+    are modes littleCMS can't handle here.
+
+    :param im: Pillow image, ideally already downsized.
+    :param intent: One of the ImageCms.Intent values.
+    """
+    icc_profile = im.info.get('icc_profile')
+    if not icc_profile or im.mode not in ('RGB', 'CMYK'):
+        return im
+    transform = get_srgb_transform(icc_profile, im.mode, intent)
+    if transform is None:
+        return im
+    logging.debug(f"Converting {im.mode} image to sRGB.")
+    converted = ImageCms.applyTransform(im, transform)
+    converted.info['icc_profile'] = srgb_profile().tobytes()
+    return converted
+
+
+# Pillow refuses to open images past twice its pixel limit as decompression
+# bombs, which would stop the huge scans the banded reader is for.  The check
+# is made in MediaResizer._downsize instead, for photos decoded whole.
+PIXEL_LIMIT = Image.MAX_IMAGE_PIXELS
+Image.MAX_IMAGE_PIXELS = None
+
+# Rough bytes held per source pixel while a band is in flight: the raw rows,
+# the decoded band and its copy when cropping or re-wrapping PNG data.
+_BAND_BYTES_PER_PIXEL = 20
+_PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+def _tiff_bands(im, rows):
+    """
+    Yields (top, band) for an uncompressed TIFF, reading the strips or tiles
+    straight out of a memory map of the file.
+    """
+    width, height = im.size
+    bits = sum(im.tag_v2.get(258, (8,)))
+    with open(im.filename, 'rb') as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            band = Image.new(im.mode, (width, bottom - top))
+            for tile in im.tile:
+                x0, y0, x1, y1 = tile[1]
+                rawmode, stride = tile[3][0], tile[3][1]
+                first, last = max(top, y0), min(bottom, y1)
+                if first >= last:
+                    continue
+                stride = stride or math.ceil((x1 - x0) * bits / 8)
+                start = tile[2] + (first - y0) * stride
+                with memoryview(mapped)[start:start + (last - first) * stride] as data:
+                    piece = Image.frombytes(im.mode, (x1 - x0, last - first),
+                                            data, 'raw', rawmode, stride, 1)
+                band.paste(piece, (x0, first - top))
+            yield top, band
+
+
+def _png_idat(fp):
+    "Yields the compressed image data of a PNG, chunk by chunk."
+    fp.seek(8)
+    while True:
+        length, chunk_type = struct.unpack('>I4s', fp.read(8))
+        if chunk_type == b'IEND':
+            return
+        if chunk_type != b'IDAT':
+            fp.seek(length + 4, os.SEEK_CUR)
+            continue
+        while length:
+            data = fp.read(min(length, 1 << 20))
+            length -= len(data)
+            yield data
+        fp.seek(4, os.SEEK_CUR)
+
+
+def _png_bands(im, rows):
+    """
+    Yields (top, band) for a non-interlaced PNG.  The zlib stream is inflated
+    a band at a time and Pillow undoes the row filters, seeded with the last
+    unfiltered row of the previous band.
+    """
+    width, height = im.size
+    rawmode = im.tile[0][3]
+    with open(im.filename, 'rb') as fp:
+        fp.seek(16)
+        bit_depth, color_type = struct.unpack('>BB', fp.read(10)[8:])
+        row_size = 1 + math.ceil(width * _PNG_CHANNELS[color_type] * bit_depth / 8)
+        chunks = _png_idat(fp)
+        inflater = zlib.decompressobj()
+        previous = b''
+        for top in range(0, height, rows):
+            count = min(rows, height - top)
+            raw = bytearray(previous)
+            wanted = len(previous) + count * row_size
+            while len(raw) < wanted:
+                data = inflater.unconsumed_tail or next(chunks)
+                raw += inflater.decompress(data, wanted - len(raw))
+            skip = 1 if previous else 0
+            band = Image.frombytes(im.mode, (width, count + skip),
+                                   zlib.compress(raw, 0), 'zip', rawmode)
+            previous = b'\0' + band.crop((0, count + skip - 1, width, count + skip)).tobytes('raw', rawmode)
+            if skip:
+                band = band.crop((0, 1, width, count + 1))
+            yield top, band
+
+
+def _band_reader(im):
+    """
+    Returns the band generator that can stream this image, or None when its
+    layout needs a full decode.
+    """
+    if im.format == 'TIFF':
+        tags = im.tag_v2
+        if tags.get(259, 1) != 1 or tags.get(284, 1) != 1:
+            return None
+        if sum(tags.get(258, (8,))) % 8:
+            return None
+        if any(tile[0] != 'raw' or tile[3][2] != 1 for tile in im.tile):
+            return None
+        return _tiff_bands
+    if im.format == 'PNG':
+        if len(im.tile) != 1 or im.info.get('interlace'):
+            return None
+        # The last row of a band seeds the next band's filters, so it has to
+        # pack back to the exact stored bytes.  That holds for 8 bit samples
+        # and 16 bit grey, Pillow decodes 16 bit colour to 8 bits.
+        if im.tile[0][3] not in ('L', 'LA', 'RGB', 'RGBA', 'I;16B'):
+            return None
+        return _png_bands
+    return None
+
+
+def banded_thumbnail(im, size, max_bytes):
+    """
+    Downsizes a large TIFF or PNG without decoding the whole raster.  Rows are
+    read in bands, box reduced by an integer factor into an intermediate image
+    and that is given the final Lanczos pass, like Pillow's reducing_gap.
+    Returns None if the file can't be read in bands.
+
+    :param im: Pillow image that was opened but not loaded.
+    :param size: Bounding box to fit the image in, as for thumbnail().
+    :param max_bytes: Rough memory cap for the whole resize.
+    """
+    bands = _band_reader(im)
+    if bands is None:
+        return None
+    width, height = im.size
+    scale = min(size[0] / width, size[1] / height, 1)
+    factor = max(1, int(1 / scale / 2))
+    reduced_size = (math.ceil(width / factor), math.ceil(height / factor))
+    budget = max_bytes - reduced_size[0] * reduced_size[1] * 4
+    rows = budget // (width * _BAND_BYTES_PER_PIXEL) // factor * factor
+    rows = max(rows, factor)
+    logging.debug(f"Resizing {im.filename} in bands of {rows} rows, reducing by {factor}.")
+    reduced = None
+    for top, band in bands(im, rows):
+        if band.mode.startswith('I;16'):
+            band = band.convert('I').point(lambda i: i * (1 / 256)).convert('L')
+        if reduced is None:
+            reduced = Image.new(band.mode, reduced_size)
+        reduced.paste(band.reduce(factor), (0, top // factor))
+    reduced.info = dict(im.info)
+    reduced.thumbnail(size, Image.Resampling.LANCZOS)
+    return reduced
+
+
+def fit_size(size, box):
+    "Returns the size an image of the given size gets when made to fit in box."
+    scale = min(box[0] / size[0], box[1] / size[1], 1)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def human_bytes(count):
+    "Formats a byte count for display."
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(count) < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+
+def human_seconds(seconds):
+    "Formats a duration for display."
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class CostModel:
+    """
+    Per file cost estimates, calibrated from the timings of previous runs.
+    Each rate is a moving average so the model follows hardware and setting
+    changes without being thrown by one odd file.
+
+    Photos are costed per source megapixel (decode and resample dominate) and
+    their output per output megapixel.  Videos are costed per second of
+    footage per megapixel of frame, keyed by source codec.
+    """
+    _smoothing = 0.2
+    _defaults = {
+        'photo': {'cpu': 0.35, 'wall': 0.4, 'bytes': 200000},
+        'video': {'cpu': 6.0, 'wall': 1.0, 'bytes': 300000},
+    }
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.rates = {}
+        try:
+            with open(self.path) as costs:
+                self.rates = json.load(costs)
+        except (OSError, ValueError):
+            logging.info(f"No usable cost history in {self.path}, using defaults.")
+
+    def _rate(self, kind, key):
+        return self.rates.get(key) or self.rates.get(kind) or self._defaults[kind]
+
+    @staticmethod
+    def photo_units(photo):
+        source = photo['width'] * photo['height'] / 1e6
+        output = fit_size((photo['width'], photo['height']), photo['box'])
+        return source, output[0] * output[1] / 1e6
+
+    @staticmethod
+    def video_units(video):
+        return video['duration'] * video['width'] * video['height'] / 1e6
+
+    def estimate_photo(self, photo):
+        "Returns (cpu seconds, wall seconds, output bytes) for one photo."
+        rate = self._rate('photo', 'photo')
+        source, output = self.photo_units(photo)
+        return rate['cpu'] * source, rate['wall'] * source, rate['bytes'] * output
+
+    def estimate_video(self, video):
+        "Returns (cpu seconds, wall seconds, output bytes) for one video."
+        rate = self._rate('video', 'video:' + video['codec'])
+        units = self.video_units(video)
+        return rate['cpu'] * units, rate['wall'] * units, rate['bytes'] * units
+
+    def _update(self, kind, key, cpu, wall, size):
+        for name in dict.fromkeys((kind, key)):
+            rate = dict(self._rate(kind, name))
+            samples = rate.get('samples', 0)
+            weight = 1 if samples == 0 else self._smoothing
+            for field, value in (('cpu', cpu), ('wall', wall), ('bytes', size)):
+                rate[field] += weight * (value - rate[field])
+            rate['samples'] = samples + 1
+            self.rates[name] = rate
+
+    def record_photo(self, photo, sample):
+        source, output = self.photo_units(photo)
+        if source and output:
+            self._update('photo', 'photo', sample['cpu'] / source,
+                         sample['wall'] / source, sample['output_bytes'] / output)
+
+    def record_video(self, video, sample):
+        units = self.video_units(video)
+        if units:
+            self._update('video', 'video:' + video['codec'], sample['cpu'] / units,
+                         sample['wall'] / units, sample['output_bytes'] / units)
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as costs:
+            json.dump(self.rates, costs, indent=2, sort_keys=True)
+
+
+# Profiler of the current process when --profile is used.  Pool workers are
+# reused for many jobs so one profiler accumulates all of a worker's jobs.
+_profiler = None
+_profiler_pid = None
+_profiler_depth = 0
+
+
+def profiled(profile_dir, function, *args, **kwargs):
+    """
+    Calls function under this process's profiler and saves the stats so far
+    to profile_dir as <pid>.pstats, since pool workers have no exit hook.
+    Nested calls run under the profiler that is already on, only the
+    outermost one turns it off and saves.
+    """
+    global _profiler, _profiler_pid, _profiler_depth
+    if _profiler_pid != os.getpid():
+        # Forked children inherit the parent's running profiler, drop it.
+        if _profiler is not None:
+            _profiler.disable()
+        _profiler = cProfile.Profile()
+        _profiler_pid = os.getpid()
+        _profiler_depth = 0
+    if _profiler_depth == 0:
+        _profiler.enable()
+    _profiler_depth += 1
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _profiler_depth -= 1
+        if _profiler_depth == 0:
+            _profiler.disable()
+            _profiler.dump_stats(os.path.join(profile_dir, f"{os.getpid()}.pstats"))
+
+
+def run_measured(command):
+    """
+    Runs a command to completion and measures it.  The child is reaped with
+    wait4 so its cpu time and peak memory are exact rather than sampled.
+
+    :param command: Argument list for the command.
+    :return: Tuple of (returncode, stdout, stderr, stats dict).
+    """
+    wall_start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output = {}
+
+    def read(name, stream):
+        output[name] = stream.read()
+        stream.close()
+
+    readers = [threading.Thread(target=read, args=(name, stream))
+               for name, stream in (('out', process.stdout), ('err', process.stderr))]
+    for reader in readers:
+        reader.start()
+    stats = reap_measured(process, command, wall_start)
+    for reader in readers:
+        reader.join()
+    return process.returncode, output['out'], output['err'], stats
+
+
+def reap_measured(process, command, wall_start):
+    """
+    Waits for a started child with wait4 and returns its stats, for commands
+    whose output is read while they run.
+
+    :param process: Popen of the child.
+    :param command: Argument list the child was started with.
+    :param wall_start: time.perf_counter() from just before it was started.
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "command": os.path.basename(command[0]),
+        "returncode": process.returncode,
+        "wall": time.perf_counter() - wall_start,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux.
+        "max_rss": usage.ru_maxrss * 1024,
+    }
+
+
+def merge_profiles(profile_dir):
+    """
+    Merges the per process stats in profile_dir into merged.pstats, which
+    snakeviz or flameprof can load, plus a plain text summary in report.txt.
+    """
+    parts = [os.path.join(profile_dir, name) for name in sorted(os.listdir(profile_dir))
+             if name.endswith('.pstats') and name != 'merged.pstats']
+    if not parts:
+        return
+    merged = pstats.Stats(*parts)
+    merged.dump_stats(os.path.join(profile_dir, 'merged.pstats'))
+    with open(os.path.join(profile_dir, 'report.txt'), 'w') as report:
+        merged.stream = report
+        merged.sort_stats('cumulative').print_stats(50)
+        merged.sort_stats('tottime').print_stats(50)
+    logging.info(f"Profile of {len(parts)} processes written to {profile_dir}")
+
+
+# ioctl that makes dst share src's extents on btrfs, XFS and other CoW file
+# systems (FICLONE from linux/fs.h).
+FICLONE = 0x40049409
+
+
+def link_file(source, destination):
+    """
+    Makes destination a copy of source as cheaply as possible: a reflink if
+    the file system supports it, otherwise a hardlink, otherwise a real copy.
+    Reflinks come first since hardlinked files share timestamps and edits.
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    os.remove(destination)
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError:
+        shutil.copyfile(source, destination)
+        return 'copy'
+
+
+class RenditionCache:
+    """
+    Content addressed store of finished renditions, shared by every folder
+    that is processed.  Entries are keyed by the hash of the source file and
+    the parameters of the rendition, so moved or duplicated sources are only
+    processed once.  An SQLite index next to the files tracks sizes and last
+    use for the LRU eviction, since hardlinked outputs share their timestamps
+    with the cache entry.
+    """
+    def __init__(self, root, budget):
+        self.root = os.path.expanduser(root)
+        self.budget = budget
+        self._connection = None
+        self._pid = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = state['_pid'] = None
+        return state
+
+    def _db(self):
+        # Connections can't cross a fork, each process opens its own.
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(os.path.join(self.root, 'index.sqlite'),
+                                               timeout=60, isolation_level=None)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS renditions ('
+                                     'key TEXT PRIMARY KEY, size INTEGER, last_used REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def key(source, params):
+        """
+        Returns the cache key of a rendition of source made with params.
+
+        :param source: Path of the source file, its content is hashed.
+        :param params: JSON serialisable description of the rendition.
+        """
+        digest = hashlib.sha256()
+        with open(source, 'rb') as src:
+            for block in iter(lambda: src.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def fetch(self, key, output):
+        """
+        Puts the cached rendition for key at output.  Returns False on a miss.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self._db().execute('DELETE FROM renditions WHERE key = ?', (key,))
+            return False
+        if os.path.lexists(output):
+            os.remove(output)
+        method = link_file(path, output)
+        self._db().execute('UPDATE renditions SET last_used = ? WHERE key = ?',
+                           (time.time(), key))
+        logging.info(f"Reused cached rendition for {output} ({method}).")
+        return True
+
+    def store(self, key, output):
+        "Adds a finished rendition to the cache."
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        link_file(output, temporary)
+        os.replace(temporary, path)
+        self._db().execute('INSERT OR REPLACE INTO renditions VALUES (?, ?, ?)',
+                           (key, os.path.getsize(path), time.time()))
+
+    def read(self, key):
+        "Returns the cached rendition for key as bytes, or None on a miss."
+        try:
+            with open(self._path(key), 'rb') as cached:
+                data = cached.read()
+        except FileNotFoundError:
+            return None
+        self._db().execute('UPDATE renditions SET last_used = ? WHERE key = ?',
+                           (time.time(), key))
+        return data
+
+    def store_bytes(self, key, data):
+        "Adds a rendition that only exists in memory to the cache."
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as cached:
+            cached.write(data)
+        os.replace(temporary, path)
+        self._db().execute('INSERT OR REPLACE INTO renditions VALUES (?, ?, ?)',
+                           (key, len(data), time.time()))
+
+    def evict(self):
+        "Removes least recently used renditions until the cache fits its budget."
+        db = self._db()
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM renditions').fetchone()[0]
+        if total <= self.budget:
+            return
+        for key, size in db.execute('SELECT key, size FROM renditions '
+                                    'ORDER BY last_used').fetchall():
+            if total <= self.budget:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            db.execute('DELETE FROM renditions WHERE key = ?', (key,))
+            total -= size
+            logging.debug(f"Evicted {key} from the rendition cache.")
+
+
+class JobQueue:
+    """
+    Lease based job queue kept in an SQLite file on the shared folder, so any
+    number of hosts can work through the same folder without a broker.  A
+    host claims a job by taking a lease on it and keeps the lease alive with
+    heartbeats; jobs whose lease runs out are claimed again by someone else.
+
+    The journal stays in DELETE mode since WAL needs shared memory, which
+    network file systems don't provide.  Paths are queued relative to the
+    folder, since every host may have it mounted somewhere else.
+
+    :param path: Path of the SQLite file.
+    :param lease: Seconds a lease lasts without a heartbeat.
+    :param root: This host's path of the folder being processed.
+    """
+    max_attempts = 3
+    poll_interval = 5
+    # Job fields holding paths under the folder.
+    path_fields = ('full_path', 'output', 'poster', 'contact_sheet')
+
+    def __init__(self, path, lease, root):
+        self.path = path
+        self.lease = lease
+        self.root = root
+        self._connection = None
+        self._pid = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = state['_pid'] = None
+        return state
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=DELETE')
+        return connection
+
+    def _db(self):
+        # Connections can't cross a fork, each process opens its own.
+        if self._pid != os.getpid():
+            self._connection = self._connect()
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY, kind TEXT, output TEXT UNIQUE, mtime REAL, '
+                'payload TEXT, state TEXT, owner TEXT, lease_expires REAL, '
+                'attempts INTEGER DEFAULT 0, params TEXT)')
+            try:
+                # Queues made before the parameters were stored.
+                self._connection.execute('ALTER TABLE jobs ADD COLUMN params TEXT')
+            except sqlite3.OperationalError:
+                pass
+            self._pid = os.getpid()
+            self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        return self._connection
+
+    def enqueue(self, kind, jobs, params):
+        """
+        Adds jobs that aren't queued yet.  Jobs whose source changed, that
+        were queued with other parameters, or that are done but whose output
+        is gone are queued again, everything else is left as it is.
+
+        :param params: JSON serialisable parameters the jobs are run with.
+        """
+        params = json.dumps(params, sort_keys=True)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        for job in jobs:
+            missing = not os.path.exists(job['output'])
+            job = self._shared(job)
+            db.execute(
+                "INSERT INTO jobs (kind, output, mtime, payload, state, params) "
+                "VALUES (?, ?, ?, ?, 'queued', ?) "
+                "ON CONFLICT(output) DO UPDATE SET mtime = excluded.mtime, "
+                "payload = excluded.payload, params = excluded.params, "
+                "state = 'queued', attempts = 0 "
+                "WHERE jobs.mtime != excluded.mtime OR jobs.params IS NOT excluded.params "
+                "OR (jobs.state = 'done' AND ?)",
+                (kind, job['output'], job['timestamp_modified'], json.dumps(job), params, missing))
+        db.execute('COMMIT')
+
+    def claim(self, kind):
+        """
+        Leases the next queued or abandoned job of this kind.
+
+        :return: Tuple of (job id, job dict), or None if there is nothing to do.
+        """
+        db = self._db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute(
+            "SELECT id, payload FROM jobs WHERE kind = ? AND (state = 'queued' "
+            "OR (state = 'running' AND lease_expires < ?)) ORDER BY id LIMIT 1",
+            (kind, now)).fetchone()
+        if row:
+            db.execute("UPDATE jobs SET state = 'running', owner = ?, lease_expires = ?, "
+                       "attempts = attempts + 1 WHERE id = ?",
+                       (self.owner, now + self.lease, row[0]))
+        db.execute('COMMIT')
+        if row is None:
+            return None
+        return row[0], self._local(json.loads(row[1]))
+
+    def _shared(self, job):
+        "Returns a copy of job with its paths relative to the folder."
+        return dict(job, **{field: os.path.relpath(job[field], self.root)
+                            for field in self.path_fields if field in job})
+
+    def _local(self, job):
+        "Resolves the relative paths of a queued job on this host."
+        return dict(job, **{field: os.path.join(self.root, job[field])
+                            for field in self.path_fields if field in job})
+
+    def unfinished(self, kind):
+        "Returns how many jobs of this kind are queued or running anywhere."
+        return self._db().execute(
+            "SELECT COUNT(*) FROM jobs WHERE kind = ? AND state IN ('queued', 'running')",
+            (kind,)).fetchone()[0]
+
+    def finish(self, job_id, succeeded, retry=True):
+        """
+        Releases a job as done, or hands it back for another try when it failed
+        for a reason that may go away and has attempts left.
+        """
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        db.execute(
+            "UPDATE jobs SET state = CASE WHEN ? THEN 'done' WHEN ? OR attempts >= ? "
+            "THEN 'failed' ELSE 'queued' END, owner = NULL, lease_expires = NULL "
+            "WHERE id = ? AND owner = ?",
+            (succeeded, not retry, self.max_attempts, job_id, self.owner))
+        db.execute('COMMIT')
+
+    def _heartbeat(self, job_id, owner, stop):
+        connection = self._connect()
+        while not stop.wait(self.lease / 3):
+            connection.execute('UPDATE jobs SET lease_expires = ? WHERE id = ? AND owner = ?',
+                               (time.time() + self.lease, job_id, owner))
+        connection.close()
+
+    def run(self, job_id, function, *args):
+        "Calls function while a background thread keeps the job's lease alive."
+        stop = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(job_id, self.owner, stop),
+                                daemon=True)
+        beat.start()
+        try:
+            return function(*args)
+        finally:
+            stop.set()
+            beat.join()
+
+
+def file_digest(path, algorithm='sha256'):
+    "Returns the hash object of a file's content."
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as src:
+        for block in iter(lambda: src.read(1 << 20), b''):
+            digest.update(block)
+    return digest
+
+
+class Uploader:
+    """
+    Sends finished renditions to another directory, an SFTP server or an
+    HTTP server accepting PUT (plain or WebDAV) while processing goes on.
+    Uploads run on a bounded thread pool and every thread keeps its own
+    connection open across files.  Files the destination already has, by
+    size and content hash, are skipped; failures are retried with backoff.
+
+    :param url: Directory path, sftp://user@host[:port]/path or
+                http(s)://host[:port]/path.
+    :param root: Local folder the remote layout is relative to.
+    """
+    def __init__(self, url, root, jobs=4, retries=3):
+        self.url = urlsplit(url)
+        self.scheme = self.url.scheme if self.url.scheme in ('sftp', 'http', 'https') else 'file'
+        self.base = self.url.path if self.scheme != 'file' else os.path.expanduser(url)
+        self.root = root
+        self.retries = retries
+        if self.scheme == 'sftp' and paramiko is None:
+            raise MediaResizerException('Uploading over sftp needs paramiko installed.')
+        # Failures that are retried and then counted as a failed upload.
+        self._errors = (OSError, http.client.HTTPException, MediaResizerException)
+        if paramiko is not None:
+            self._errors += (paramiko.SSHException,)
+        self._executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='upload')
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._made_dirs = set()
+        self._futures = []
+        self.uploaded = self.skipped = 0
+        self.failed = []
+
+    def submit(self, path):
+        "Queues a finished file for upload."
+        remote = posixpath.join(self.base, *os.path.relpath(path, self.root).split(os.sep))
+        self._futures.append(self._executor.submit(self._upload_with_retries, path, remote))
+
+    def close(self):
+        "Waits for every upload to finish and closes the connections."
+        for future in self._futures:
+            future.result()
+        self._executor.shutdown()
+        for connection in self._connections:
+            connection.close()
+        print(f"{bcolors.OKGREEN}Uploaded {self.uploaded} files, {self.skipped} were already there.{bcolors.ENDC}")
+        for path in self.failed:
+            logging.error(f"{bcolors.FAIL}Could not upload {path}{bcolors.ENDC}")
+
+    def _upload_with_retries(self, path, remote):
+        for attempt in range(1, self.retries + 1):
+            try:
+                sent = self._upload(path, remote)
+                with self._lock:
+                    if sent:
+                        self.uploaded += 1
+                    else:
+                        self.skipped += 1
+                return
+            except self._errors as ex:
+                logging.warning(f"{bcolors.WARNING}Upload of {path} failed "
+                                f"(attempt {attempt}): {ex}{bcolors.ENDC}")
+                self._drop_connection()
+                if attempt < self.retries:
+                    time.sleep(2 ** (attempt - 1) + random.random())
+        with self._lock:
+            self.failed.append(path)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            host, port = self.url.hostname, self.url.port
+            if self.scheme == 'sftp':
+                transport = paramiko.Transport((host, port or 22))
+                transport.connect(username=self.url.username, password=self.url.password,
+                                  pkey=None if self.url.password else self._private_key())
+                connection = paramiko.SFTPClient.from_transport(transport)
+            elif self.scheme == 'https':
+                connection = http.client.HTTPSConnection(host, port, timeout=120)
+            elif self.scheme == 'http':
+                connection = http.client.HTTPConnection(host, port, timeout=120)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _private_key():
+        agent_keys = paramiko.Agent().get_keys()
+        if agent_keys:
+            return agent_keys[0]
+        for name in ('id_ed25519', 'id_rsa'):
+            path = os.path.expanduser(os.path.join('~', '.ssh', name))
+            if os.path.exists(path):
+                return paramiko.PKey.from_path(path)
+        return None
+
+    def _drop_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _upload(self, path, remote):
+        """
+        Uploads one file.  Returns False if the destination already had it.
+        """
+        return getattr(self, '_upload_' + self.scheme.rstrip('s'))(path, remote)
+
+    def _upload_file(self, path, remote):
+        if os.path.exists(remote) and os.path.getsize(remote) == os.path.getsize(path) \
+                and file_digest(remote).digest() == file_digest(path).digest():
+            return False
+        os.makedirs(os.path.dirname(remote), exist_ok=True)
+        temporary = remote + '.part'
+        shutil.copy2(path, temporary)
+        os.replace(temporary, remote)
+        return True
+
+    def _upload_sftp(self, path, remote):
+        sftp = self._connection()
+        try:
+            attributes = sftp.stat(remote)
+        except FileNotFoundError:
+            attributes = None
+        if attributes is not None and attributes.st_size == os.path.getsize(path):
+            remote_digest = hashlib.sha256()
+            with sftp.open(remote, 'rb') as remote_file:
+                remote_file.prefetch()
+                for block in iter(lambda: remote_file.read(1 << 20), b''):
+                    remote_digest.update(block)
+            if remote_digest.digest() == file_digest(path).digest():
+                return False
+        self._make_remote_dirs(posixpath.dirname(remote), sftp)
+        sftp.put(path, remote + '.part')
+        sftp.posix_rename(remote + '.part', remote)
+        return True
+
+    def _upload_http(self, path, remote):
+        connection = self._connection()
+        target = quote(remote)
+        size = os.path.getsize(path)
+        digest = file_digest(path)
+        connection.request('HEAD', target, headers=self._headers())
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200 and int(response.getheader('Content-Length', -1)) == size:
+            # Servers expose the hash as an RFC 3230 Digest or an MD5 ETag.
+            sha = 'sha-256=' + base64.b64encode(digest.digest()).decode()
+            etag = (response.getheader('ETag') or '').strip('"')
+            if sha in (response.getheader('Digest') or '') or etag == file_digest(path, 'md5').hexdigest():
+                return False
+        self._make_remote_dirs(posixpath.dirname(remote), connection)
+        with open(path, 'rb') as body:
+            connection.request('PUT', target, body=body, headers=self._headers({
+                'Content-Length': str(size),
+                'Digest': 'sha-256=' + base64.b64encode(digest.digest()).decode(),
+            }))
+            response = connection.getresponse()
+            response.read()
+        if response.status not in (200, 201, 204):
+            raise MediaResizerException(f"PUT {remote} returned {response.status}")
+        return True
+
+    def _headers(self, extra=None):
+        headers = dict(extra or {})
+        if self.url.username:
+            credentials = f"{self.url.username}:{self.url.password or ''}".encode()
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode()
+        return headers
+
+    def _make_remote_dirs(self, directory, connection):
+        """
+        Creates the remote directory and its parents once per run.  Errors are
+        ignored, the directory usually exists already and plain PUT servers
+        create it themselves.
+        """
+        missing = []
+        while directory not in ('', '/') and directory not in self._made_dirs:
+            missing.append(directory)
+            directory = posixpath.dirname(directory)
+        for directory in reversed(missing):
+            if self.scheme == 'sftp':
+                try:
+                    connection.mkdir(directory)
+                except OSError:
+                    pass
+            else:
+                connection.request('MKCOL', quote(directory) + '/', headers=self._headers())
+                connection.getresponse().read()
+            with self._lock:
+                self._made_dirs.add(directory)
+
+
+class ArchiveWriter:
+    """
+    Appends encoded renditions straight into a single uncompressed tar or
+    zip, so a folder of thumbnails costs one file's worth of metadata
+    operations on the NAS.  Members are stored, never deflated, and a JSON
+    index of each member's data offset and size is written next to the
+    archive so clients can fetch one member with a range read.
+    """
+    def __init__(self, path, archive_format):
+        if archive_format not in ('tar', 'zip'):
+            raise MediaResizerException(f"Unknown archive format {archive_format}.")
+        self.path = path
+        self.format = archive_format
+        self.index = {}
+        if archive_format == 'tar':
+            self._archive = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+        else:
+            self._archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+
+    def add(self, name, data, mtime):
+        "Appends one member and records where its data starts."
+        if self.format == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            self._archive.addfile(info, io.BytesIO(data))
+            # The offset is past the padded data that was just written.
+            offset = self._archive.offset - math.ceil(len(data) / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        else:
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            self._archive.writestr(info, data)
+            offset = info.header_offset + len(info.FileHeader())
+        self.index[name] = {"offset": offset, "size": len(data), "mtime": mtime}
+
+    def close(self):
+        "Finishes the archive and writes its index.  Returns the index path."
+        self._archive.close()
+        index_path = self.path + '.index.json'
+        with open(index_path, 'w') as index:
+            json.dump({"archive": os.path.basename(self.path), "format": self.format,
+                       "members": self.index}, index, indent=1)
+        return index_path
+
+
+# JPEG segments that only hold metadata: APP1 (EXIF, XMP), APP13 (IPTC) and
+# comments.  Everything else, ICC profiles included, decides the pixels.
+_JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+
+def _jpeg_pixel_digest(src, digest):
+    src.seek(2)
+    while True:
+        marker = src.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise MediaResizerException('Broken JPEG segment.')
+        if marker[1] == 0xDA:
+            # Start of scan, the entropy coded data runs to the end.
+            digest.update(marker)
+            for block in iter(lambda: src.read(1 << 20), b''):
+                digest.update(block)
+            return digest
+        length = src.read(2)
+        body = src.read(struct.unpack('>H', length)[0] - 2)
+        if marker[1] not in _JPEG_METADATA_MARKERS:
+            digest.update(marker + length + body)
+
+
+# PNG chunks that decide the pixels or their colours, the rest is metadata.
+_PNG_PIXEL_CHUNKS = {b'IHDR', b'PLTE', b'tRNS', b'IDAT', b'iCCP', b'sRGB', b'gAMA', b'cHRM'}
+
+
+def _png_pixel_digest(src, digest):
+    src.seek(8)
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise MediaResizerException('Broken PNG chunk.')
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            return digest
+        if chunk_type in _PNG_PIXEL_CHUNKS:
+            digest.update(chunk_type)
+            while length:
+                data = src.read(min(length, 1 << 20))
+                if not data:
+                    raise MediaResizerException('Broken PNG chunk.')
+                length -= len(data)
+                digest.update(data)
+            src.seek(4, os.SEEK_CUR)
+        else:
+            src.seek(length + 4, os.SEEK_CUR)
+
+
+def pixel_digest(path):
+    """
+    Returns a hex digest of everything in an image file that decides its
+    pixels, but not of its metadata, without decoding it.  JPEGs and PNGs
+    skip their metadata segments or chunks and TIFFs hash their strips or
+    tiles.  Other formats hash the whole file, so a metadata edit reads as a
+    pixel change and the photo is resized again.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as src:
+        signature = src.read(8)
+        if signature[:2] == b'\xff\xd8':
+            return _jpeg_pixel_digest(src, digest).hexdigest()
+        if signature == b'\x89PNG\r\n\x1a\n':
+            return _png_pixel_digest(src, digest).hexdigest()
+    with Image.open(path) as im:
+        if im.format == 'TIFF':
+            tags = im.tag_v2
+            offsets = tags.get(324) or tags.get(273)
+            counts = tags.get(325) or tags.get(279)
+            if offsets and counts:
+                digest.update(f"{im.mode} {im.size}".encode())
+                digest.update(repr(tags.get(317)).encode() + repr(tags.get(34675)).encode())
+                with open(path, 'rb') as src:
+                    for offset, count in zip(offsets, counts):
+                        src.seek(offset)
+                        while count:
+                            block = src.read(min(count, 1 << 20))
+                            if not block:
+                                break
+                            count -= len(block)
+                            digest.update(block)
+                return digest.hexdigest()
+    return file_digest(path).hexdigest()
+
+
+def _metadata_tags(metadata):
+    return metadata.get_exif_tags() + metadata.get_iptc_tags() + metadata.get_xmp_tags()
+
+
+def metadata_digest(metadata):
+    "Returns a hex digest of the EXIF, IPTC and XMP tags of a GExiv2 Metadata."
+    digest = hashlib.sha256()
+    for tag in sorted(_metadata_tags(metadata)):
+        digest.update(tag.encode() + b'\0')
+        for value in metadata.get_tag_multiple(tag) or [metadata[tag]]:
+            digest.update(value.encode() + b'\0')
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Remembers the pixel and metadata digests of the source each photo
+    output was made from, so --resync can tell which outputs only need
+    their metadata rewritten.  Kept in SQLite next to the outputs so hosts
+    in distributed mode can update it together.
+    """
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS photos (output TEXT PRIMARY KEY, '
+                         'pixels TEXT, metadata TEXT, params TEXT)')
+
+    def get(self, output):
+        row = self._db.execute('SELECT pixels, metadata, params FROM photos WHERE output = ?',
+                               (output,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('pixels', 'metadata', 'params'), row))
+
+    def put(self, output, hashes):
+        self._db.execute('INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?)',
+                         (output, hashes['pixels'], hashes['metadata'], hashes['params']))
+
+
+# ioctl returning the physical extents of a file (FS_IOC_FIEMAP from
+# linux/fs.h), with the layout of struct fiemap and struct fiemap_extent.
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQ2QL3L')
+
+
+def disk_position(path):
+    """
+    Returns a sort key placing a file by where its data starts on disk.  Uses
+    the first physical extent where the file system reports extents, and the
+    inode number elsewhere (NFS, most FUSE mounts) since inodes are usually
+    allocated near their data.
+    """
+    stinfo = os.stat(path)
+    request = bytearray(_FIEMAP.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size))
+    try:
+        with open(path, 'rb') as src:
+            fcntl.ioctl(src.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return stinfo.st_dev, 1, stinfo.st_ino
+    if not _FIEMAP.unpack_from(request)[3]:
+        return stinfo.st_dev, 1, stinfo.st_ino
+    return stinfo.st_dev, 0, _FIEMAP_EXTENT.unpack_from(request, _FIEMAP.size)[1]
+
+
+def order_by_disk(jobs):
+    "Sorts jobs by where their sources sit on disk."
+    return sorted(jobs, key=lambda job: disk_position(job['full_path']))
+
+
+class ReadAhead:
+    """
+    Keeps the page cache a few sources ahead of the photo workers, so their
+    disk reads overlap with resizing, and drops sources once they are done.
+    The fadvise calls run on their own thread since WILLNEED can block while
+    the kernel queues the reads.
+
+    :param jobs: Job dicts in the order the workers take them.
+    :param depth: How many sources to prefetch past the ones being read.
+    :param in_flight: How many jobs the workers have taken beyond the last
+                      finished one.  Those are already being read, so the
+                      prefetch window starts after them.
+    """
+    def __init__(self, jobs, depth, in_flight=0):
+        self._paths = [job['full_path'] for job in jobs]
+        self._depth = depth
+        self.in_flight = in_flight
+        self._requests = SimpleQueue()
+        self._thread = threading.Thread(target=self._advise, daemon=True)
+        self._thread.start()
+        for path in self._paths[in_flight:in_flight + depth]:
+            self._requests.put((path, os.POSIX_FADV_WILLNEED))
+
+    def _advise(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            path, advice = request
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, advice)
+                finally:
+                    os.close(fd)
+            except OSError as ex:
+                logging.debug(f"fadvise failed for {path}: {ex}")
+
+    def done(self, index):
+        "Marks the job at index as finished."
+        self._requests.put((self._paths[index], os.POSIX_FADV_DONTNEED))
+        ahead = index + self.in_flight + self._depth
+        if ahead < len(self._paths):
+            self._requests.put((self._paths[ahead], os.POSIX_FADV_WILLNEED))
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+
+def read_pressure(resource):
+    """
+    Returns the share of the last ten seconds in which some task stalled on
+    cpu, io or memory, from the kernel's pressure stall information, or None
+    where /proc/pressure doesn't exist.
+    """
+    try:
+        with open(f'/proc/pressure/{resource}') as pressure:
+            fields = pressure.readline().split()
+        return float(fields[1].partition('=')[2])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Autoscaler:
+    """
+    Decides how many photos and videos are worked on at once.  Every interval
+    it samples cpu, io and memory pressure, the load average, iowait, memory
+    in use and how many photos finished, then moves each limit by one:
+
+    * memory pressure shrinks both before the kernel has to swap;
+    * io pressure shrinks the photos, more readers only add seeking;
+    * cpu pressure shrinks the photos, or the videos once the photos are at
+      the floor;
+    * spare cpu grows the photos, unless the last worker added didn't raise
+      the throughput, and the videos once the photos are at the ceiling or
+      none are left waiting.
+
+    Where the kernel has no PSI the load average, iowait and memory in use
+    stand in for it.  The pool is started at the ceiling, the limits only
+    decide how many jobs are handed to it.
+
+    :param workers: Photo workers to start with.
+    :param floor: Fewest photo workers.
+    :param ceiling: Most photo workers.
+    :param max_videos: Most videos at once, the fewest is one.
+    :param interval: Seconds between decisions.
+
+    The caller keeps backlog at the number of photos not yet handed out.
+    """
+    # Percent of the time some task stalled.
+    CPU_HIGH = 40.0
+    CPU_LOW = 10.0
+    IO_HIGH = 30.0
+    MEMORY_HIGH = 10.0
+    # Memory in use, in percent, taken as pressure without PSI.
+    MEMORY_USED_HIGH = 90.0
+    # A new worker has to raise the throughput by this much to stay.
+    MIN_GAIN = 1.05
+
+    def __init__(self, workers, floor, ceiling, max_videos, interval):
+        self.photos = min(max(workers, floor), ceiling)
+        self.videos = 1
+        self.backlog = 0
+        self._floor = floor
+        self._ceiling = ceiling
+        self._max_videos = max_videos
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._finished = 0
+        self._stages = {}
+        self._last_rate = None
+        self._grew = False
+        self._held = 0
+        self._stop = threading.Event()
+        # Starts the interval the first iowait is measured over.
+        psutil.cpu_times_percent()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def finished(self, record):
+        "Counts a finished photo and the time it spent in each stage."
+        with self._lock:
+            self._finished += 1
+            for stage, seconds in record.get('stages', {}).items():
+                self._stages[stage] = self._stages.get(stage, 0) + seconds
+
+    def sample(self):
+        with self._lock:
+            finished, self._finished = self._finished, 0
+            stages, self._stages = self._stages, {}
+        cpus = cpu_count()
+        return {
+            'cpu': read_pressure('cpu'),
+            'io': read_pressure('io'),
+            'memory': read_pressure('memory'),
+            'load': os.getloadavg()[0] / cpus,
+            'iowait': getattr(psutil.cpu_times_percent(), 'iowait', 0.0),
+            'memory_used': psutil.virtual_memory().percent,
+            'rate': finished / self._interval,
+            # Seconds per second of each stage, summed over the workers.
+            'stages': {stage: seconds / self._interval for stage, seconds in stages.items()},
+        }
+
+    def decide(self, sample):
+        """
+        Returns the photo and video limits for a sample and the reason for
+        them.
+        """
+        cpu, io, memory = sample['cpu'], sample['io'], sample['memory']
+        if cpu is None:
+            # Runnable tasks beyond the cores, as a percent of the cores.
+            cpu = max(sample['load'] - 1, 0) * 100
+        if io is None:
+            io = sample['iowait']
+        memory_high = (sample['memory_used'] > self.MEMORY_USED_HIGH if memory is None
+                       else memory > self.MEMORY_HIGH)
+        photos, videos = self.photos, self.videos
+        grew = False
+        # Without waiting photos the throughput only says the queue ran dry.
+        backlog = self.backlog > 0
+        if memory_high:
+            photos, videos, reason = photos - 1, videos - 1, 'memory pressure'
+        elif io > self.IO_HIGH:
+            photos, reason = photos - 1, 'io pressure'
+        elif cpu > self.CPU_HIGH:
+            reason = 'cpu pressure'
+            if photos > self._floor:
+                photos -= 1
+            else:
+                videos -= 1
+        elif backlog and self._grew and sample['rate'] < self._last_rate * self.MIN_GAIN:
+            # Something besides the cpu is the limit, hold off growing again
+            # for a few intervals.
+            photos, reason = photos - 1, 'no gain from the last worker'
+            self._held = 3
+        elif cpu < self.CPU_LOW and backlog and self._held:
+            self._held -= 1
+            reason = 'spare cpu, holding'
+        elif cpu < self.CPU_LOW and backlog and photos < self._ceiling:
+            photos, reason, grew = photos + 1, 'spare cpu', True
+        elif cpu < self.CPU_LOW:
+            videos, reason = videos + 1, 'spare cpu'
+        else:
+            reason = 'steady'
+        photos = min(max(photos, self._floor), self._ceiling)
+        videos = min(max(videos, 1), self._max_videos)
+        self._grew = grew and photos != self.photos
+        self._last_rate = sample['rate']
+        return photos, videos, reason
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            sample = self.sample()
+            photos, videos, reason = self.decide(sample)
+            pressure = self._percent
+            stages = ', '.join(f"{stage} {busy:.1f}"
+                               for stage, busy in sorted(sample['stages'].items(),
+                                                         key=lambda item: -item[1]))
+            logging.info(f"Autoscale: photos {self.photos} -> {photos}, videos {self.videos} -> {videos}"
+                         f" ({reason}; psi cpu {pressure(sample['cpu'])} io {pressure(sample['io'])}"
+                         f" memory {pressure(sample['memory'])}, load {sample['load']:.2f}/core,"
+                         f" iowait {sample['iowait']:.1f}%, memory {sample['memory_used']:.0f}%,"
+                         f" {sample['rate']:.2f} photos/s, busy stages {stages or 'none'})")
+            self.photos, self.videos = photos, videos
+
+    @staticmethod
+    def _percent(value):
+        return 'n/a' if value is None else f"{value:.1f}%"
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def encode_jpeg(im, quality=None, **options):
+    "Encodes an image to JPEG bytes in memory, with Pillow's default quality if none is given."
+    if quality is not None:
+        options['quality'] = quality
+    buffer = io.BytesIO()
+    im.save(buffer, 'jpeg', **options)
+    return buffer.getvalue()
+
+
+# SSIM stabilising constants for 8 bit data.
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+
+def ssim(reference, candidate):
+    """
+    Returns the mean SSIM of the luminance of two images of the same size,
+    over 8x8 blocks.  Block statistics come from Pillow's reduce() on float
+    images so the whole computation stays in C.
+    """
+    x = reference.convert('L').convert('F')
+    y = candidate.convert('L').convert('F')
+    product = ImageMath.lambda_eval
+    stats = {
+        'mx': x.reduce(8),
+        'my': y.reduce(8),
+        'xx': product(lambda a: a['x'] * a['x'], x=x).reduce(8),
+        'yy': product(lambda a: a['y'] * a['y'], y=y).reduce(8),
+        'xy': product(lambda a: a['x'] * a['y'], x=x, y=y).reduce(8),
+    }
+    ssim_map = ImageMath.lambda_eval(
+        lambda a: ((2 * a['mx'] * a['my'] + _SSIM_C1) * (2 * (a['xy'] - a['mx'] * a['my']) + _SSIM_C2))
+        / ((a['mx'] * a['mx'] + a['my'] * a['my'] + _SSIM_C1)
+           * (a['xx'] - a['mx'] * a['mx'] + a['yy'] - a['my'] * a['my'] + _SSIM_C2)),
+        **stats)
+    return ssim_map.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+
+# Last quality each search settled on in this process.  Photos from one
+# shoot need similar qualities, so it is probed first.
+_quality_hint = None
+
+
+def _bisect_quality(low, high, passes, prefer_low):
+    """
+    Finds the lowest (prefer_low) or highest quality in [low, high] for which
+    passes(quality) holds, assuming it is monotonic.  Returns None if none do.
+    """
+    found = None
+    probe = _quality_hint if _quality_hint and low <= _quality_hint <= high else None
+    while low <= high:
+        quality = probe or (low + high) // 2
+        probe = None
+        if passes(quality):
+            found = quality
+            low, high = (low, quality - 1) if prefer_low else (quality + 1, high)
+        else:
+            low, high = (quality + 1, high) if prefer_low else (low, quality - 1)
+    return found
+
+
+def search_jpeg_quality(im, max_bytes=None, min_ssim=None, low=20, high=95, **options):
+    """
+    Bisects for the JPEG quality that meets a byte budget and/or an SSIM
+    floor, encoding to memory and reusing the one resampled image for every
+    attempt.
+
+    :param im: The resized image.
+    :param max_bytes: Highest acceptable size of the JPEG.
+    :param min_ssim: Lowest acceptable SSIM against im.
+    :return: Tuple of (quality, JPEG bytes).
+    """
+    global _quality_hint
+    encoded = {}
+
+    def encode(quality):
+        if quality not in encoded:
+            encoded[quality] = encode_jpeg(im, quality, **options)
+        return encoded[quality]
+
+    quality = high
+    if max_bytes:
+        fits = _bisect_quality(low, high, lambda q: len(encode(q)) <= max_bytes, prefer_low=False)
+        if fits is None:
+            logging.warning(f"{bcolors.WARNING}Even quality {low} is over {max_bytes} bytes.{bcolors.ENDC}")
+        quality = fits or low
+    if min_ssim:
+        reference = im.convert('RGB')
+        good = _bisect_quality(
+            low, quality, lambda q: ssim(reference, Image.open(io.BytesIO(encode(q)))) >= min_ssim,
+            prefer_low=True)
+        quality = good or quality
+    _quality_hint = quality
+    return quality, encode(quality)
+
+
+# Failures that can go away on their own, so the job is worth another try.
+_TRANSIENT_ERRNOS = {
+    errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.EIO, errno.ENOMEM,
+    errno.ETIMEDOUT, errno.ESTALE, errno.EMFILE, errno.ENFILE,
+}
+
+
+def is_transient(ex):
+    "Tells whether a job that failed with this exception may succeed if retried."
+    if isinstance(ex, (MemoryError, TimeoutError, sqlite3.OperationalError)):
+        return True
+    if isinstance(ex, SubprocessError):
+        # Killed by a signal, usually the OOM killer or a shutdown.
+        return ex.returncode < 0
+    return isinstance(ex, OSError) and ex.errno in _TRANSIENT_ERRNOS
+
+
+class StageTimer:
+    """
+    Measures a job's wall time per stage, plus its total wall and cpu time.
+    """
+    def __init__(self):
+        self.stages = {}
+        self._wall_start = self._mark = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def lap(self, stage):
+        "Charges the time since the previous lap to stage."
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self._mark
+        self._mark = now
+
+    def wall(self):
+        return time.perf_counter() - self._wall_start
+
+    def cpu(self):
+        return time.process_time() - self._cpu_start
+
+
+def job_record(kind, job, timer, status='ok', action='rendered', **fields):
+    """
+    Returns the result record of one job.  Workers send these back to the
+    main process, which uses them for the report, retries, the cost model
+    and the outputs' next steps.
+
+    :param kind: 'photo' or 'video'.
+    :param job: The job dict.
+    :param timer: StageTimer started when the job was.
+    :param fields: Extra fields such as output_bytes, data or hashes.
+    """
+    record = {
+        "kind": kind,
+        "input": job['input'],
+        "output": job['output'],
+        "status": status,
+        "action": action,
+        "wall": timer.wall(),
+        "cpu": timer.cpu(),
+        "stages": dict(timer.stages),
+        "input_bytes": job.get('input_bytes', 0),
+        "output_bytes": 0,
+        "width": job.get('width', 0),
+        "height": job.get('height', 0),
+        "error": None,
+        "message": None,
+        "transient": False,
+    }
+    record.update(fields)
+    return record
+
+
+def failed_record(kind, job, timer, ex, **fields):
+    "Returns the record of a job that raised ex, logging the failure."
+    logging.error(f"{bcolors.FAIL}Cannot create new {kind} for {job['input']}: {ex}{bcolors.ENDC}")
+    return job_record(kind, job, timer, status='failed', action=None,
+                      error=type(ex).__name__, message=str(ex)[:500],
+                      transient=is_transient(ex), **fields)
+
+
+class RunReport:
+    """
+    Collects the result records of a run, keeping the last attempt of each
+    job, and writes them with a summary as JSON, CSV or SQLite.  The SQLite
+    form accumulates runs so it can feed throughput dashboards.
+    """
+    # Fields that are only for the main process, never for the report.
+    _internal = ('data', 'hashes')
+    _columns = ('kind', 'input', 'output', 'status', 'action', 'attempts', 'error',
+                'message', 'transient', 'wall', 'cpu', 'input_bytes', 'output_bytes',
+                'width', 'height', 'output_width', 'output_height', 'returncode', 'max_rss',
+                'poster_error')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.started = time.time()
+        self.records = {}
+
+    def add(self, record):
+        record = {key: value for key, value in record.items() if key not in self._internal}
+        previous = self.records.get(record['output'])
+        record['attempts'] = previous['attempts'] + 1 if previous else 1
+        self.records[record['output']] = record
+
+    def should_retry(self, job, retries):
+        "Tells whether the job failed transiently and has retries left."
+        record = self.records.get(job['output'])
+        return (record is not None and record['status'] == 'failed'
+                and record['transient'] and record['attempts'] <= retries)
+
+    def summary(self):
+        records = list(self.records.values())
+        elapsed = time.time() - self.started
+        summary = {
+            "folder": self.folder,
+            "started": self.started,
+            "elapsed": elapsed,
+            "jobs": len(records),
+            "input_bytes": sum(record['input_bytes'] for record in records),
+            "output_bytes": sum(record['output_bytes'] for record in records),
+            "cpu": sum(record['cpu'] for record in records),
+            "retried": sum(record['attempts'] > 1 for record in records),
+            "by_status": {},
+            "by_action": {},
+            "errors": {},
+        }
+        for record in records:
+            status = f"{record['kind']} {record['status']}"
+            summary['by_status'][status] = summary['by_status'].get(status, 0) + 1
+            if record['action']:
+                summary['by_action'][record['action']] = summary['by_action'].get(record['action'], 0) + 1
+            if record['error']:
+                summary['errors'][record['error']] = summary['errors'].get(record['error'], 0) + 1
+        summary['jobs_per_second'] = len(records) / elapsed if elapsed else 0
+        summary['input_bytes_per_second'] = summary['input_bytes'] / elapsed if elapsed else 0
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Run summary.{bcolors.ENDC}")
+        for status, count in sorted(summary['by_status'].items()):
+            colour = bcolors.FAIL if status.endswith('failed') else bcolors.OKGREEN
+            print(f"{colour}{status}: {count}{bcolors.ENDC}")
+        for error, count in sorted(summary['errors'].items()):
+            print(f"{bcolors.FAIL}  {error}: {count}{bcolors.ENDC}")
+        print(f"{human_bytes(summary['input_bytes'])} in, {human_bytes(summary['output_bytes'])} out "
+              f"in {human_seconds(summary['elapsed'])}, {summary['jobs_per_second']:.2f} files/s")
+
+    def _rows(self):
+        for record in self.records.values():
+            row = {column: record.get(column) for column in self._columns}
+            row['stages'] = json.dumps(record['stages'], sort_keys=True)
+            yield row
+
+    def write(self, path):
+        "Writes the report, in the format the path's extension asks for."
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.csv':
+            with open(path, 'w', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=self._columns + ('stages',))
+                writer.writeheader()
+                writer.writerows(self._rows())
+        elif extension in ('.sqlite', '.db'):
+            db = sqlite3.connect(path, timeout=120)
+            db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, '
+                       'folder TEXT, started REAL, summary TEXT)')
+            db.execute(f"CREATE TABLE IF NOT EXISTS jobs (run_id INTEGER, "
+                       f"{', '.join(self._columns)}, stages TEXT)")
+            with db:
+                run_id = db.execute('INSERT INTO runs (folder, started, summary) VALUES (?, ?, ?)',
+                                    (self.folder, self.started, json.dumps(self.summary()))).lastrowid
+                db.executemany(
+                    f"INSERT INTO jobs VALUES (?, {', '.join('?' * (len(self._columns) + 1))})",
+                    [(run_id, *row.values()) for row in self._rows()])
+            db.close()
+        else:
+            with open(path, 'w') as report:
+                json.dump({"summary": self.summary(), "records": list(self.records.values())},
+                          report, indent=1)
+        logging.info(f"Run report written to {path}")
+
+
+def unwrap_self_queue(arg, **kwarg):
+    if arg[0]._profile_dir:
+        return profiled(arg[0]._profile_dir, MediaResizer.work_queue, *arg, **kwarg)
+    return MediaResizer.work_queue(*arg, **kwarg)
+
+
 def unwrap_self_photos(arg, **kwarg):
-    return MediaResizer.resize_image(*arg, **kwarg)
+    method = MediaResizer.resync_image if arg[0]._resync else MediaResizer.resize_image
+    if arg[0]._profile_dir:
+        return profiled(arg[0]._profile_dir, method, *arg, **kwarg)
+    return method(*arg, **kwarg)
 
 
 class bcolors:
@@ -65,6 +1802,15 @@ class MediaResizerException(Exception):
         return repr(self.message)
 
 
+class SubprocessError(MediaResizerException):
+    """
+    A helper program such as HandBrakeCLI exited with an error.
+    """
+    def __init__(self, message, returncode):
+        super().__init__(message)
+        self.returncode = returncode
+
+
 class MediaResizer:
     _arguments = None
     _log_level = 'WARN'
@@ -73,6 +1819,39 @@ class MediaResizer:
     _folder = ''
     _new_folder = ''
     _thread_list = []
+    _color_management = True
+    _intent = ImageCms.Intent.PERCEPTUAL
+    _max_memory = 512 * 1024 * 1024
+    _workers = 1
+    _profile_dir = ''
+    _cache = None
+    _queue = None
+    _uploader = None
+    _archive_format = None
+    _archive = None
+    _use_previews = False
+    _resync = False
+    _manifest = None
+    _disk_order = False
+    _readahead = 0
+    _target_size = None
+    _target_ssim = None
+    _report = None
+    _retries = 1
+    _posters = False
+    _sheet_grid = 4, 3
+    _sheet_tile = 320, 180
+    _autoscale = False
+    _min_workers = 1
+    _max_workers = 1
+    _max_videos = 1
+    _handbrake_settings = [
+        '-e', 'x264',
+        '-t', '1',
+        '--h264-profile', 'main',
+        '--x264-preset', 'slower',
+        '--quality', '21',
+    ]
 
     def __init__(self):
         """
@@ -80,6 +1859,46 @@ class MediaResizer:
         """
         self._arguments = docopt(__doc__, version='0.1')
         self._set_logging_verbosity()
+        self._set_color_management()
+        self._max_memory = int(self._arguments['--max-memory']) * 1024 * 1024
+        self._workers = int(self._arguments['--workers'] or max(cpu_count() - 2, 1))
+        self._archive_format = self._arguments['--archive']
+        self._use_previews = self._arguments['--previews']
+        self._resync = self._arguments['--resync']
+        self._disk_order = self._arguments['--disk-order']
+        self._readahead = int(self._arguments['--readahead'])
+        if self._arguments['--target-size']:
+            self._target_size = int(self._arguments['--target-size']) * 1024
+        if self._arguments['--target-ssim']:
+            self._target_ssim = float(self._arguments['--target-ssim'])
+        self._retries = int(self._arguments['--retries'])
+        self._posters = self._arguments['--posters']
+        self._sheet_grid = tuple(int(count) for count in self._arguments['--sheet'].split('x'))
+        self._autoscale = self._arguments['--autoscale']
+        self._min_workers = int(self._arguments['--min-workers'])
+        self._max_workers = int(self._arguments['--max-workers'] or cpu_count())
+        self._max_videos = int(self._arguments['--max-videos'])
+        if self._autoscale and self._min_workers > self._max_workers:
+            raise MediaResizerException('--min-workers is more than --max-workers.')
+        if self._autoscale and self._arguments['--distributed']:
+            raise MediaResizerException('--autoscale doesn\'t work with the --distributed job queue yet.')
+        if self._resync and self._archive_format:
+            raise MediaResizerException('--resync works on photo files, not on --archive output.')
+        if self._archive_format and self._arguments['--distributed']:
+            raise MediaResizerException('Hosts can\'t share one archive, use --archive without --distributed.')
+        if self._arguments['--cache']:
+            self._cache = RenditionCache(self._arguments['--cache'],
+                                         int(self._arguments['--cache-size']) * 1024 * 1024)
+
+    def __getstate__(self):
+        # Workers get a copy of this object, uploads only happen in the main
+        # process.
+        state = dict(self.__dict__)
+        state.pop('_uploader', None)
+        state.pop('_archive', None)
+        state.pop('_manifest', None)
+        state.pop('_report', None)
+        return state
 
     def _set_logging_verbosity(self):
         """
@@ -94,12 +1913,166 @@ class MediaResizer:
         logging.basicConfig(level=self._log_level,
                             format='%(asctime)s %(message)s')
 
-    def consume_video(self, queue):
+    def _set_color_management(self):
+        """
+        Sets the colour management options passed in the cli.
+        """
+        self._color_management = not self._arguments['--no-color-management']
+        intent = self._arguments['--intent']
+        if intent not in RENDERING_INTENTS:
+            raise MediaResizerException(f"Unknown rendering intent {intent}.")
+        self._intent = RENDERING_INTENTS[intent]
+
+    def consume_video(self, queue, results):
+        # Items are (index, video) so results from several consumers can be
+        # matched to their jobs.
         while True:
             item = queue.get()
             if item is None:
                 break
-            self.convert_video(item)
+            index, video = item
+            if self._profile_dir:
+                results.put((index, profiled(self._profile_dir, self.convert_video, video)))
+            else:
+                results.put((index, self.convert_video(video)))
+
+    def _rendition_params(self, kind):
+        """
+        Returns everything besides the source that decides what a rendition
+        looks like, for the rendition cache key.
+        """
+        if kind == 'video':
+            return {'kind': kind, 'handbrake': self._handbrake_settings}
+        return {
+            'kind': kind,
+            'size': self._default_size,
+            'color_management': self._color_management,
+            'intent': int(self._intent),
+            'previews': self._use_previews,
+            'target_size': self._target_size,
+            'target_ssim': self._target_ssim,
+            # Archives get only the EXIF, copied by Pillow, files get EXIF,
+            # IPTC and XMP from GExiv2.
+            'metadata': 'pillow-exif' if self._archive_format else 'exiv2',
+        }
+
+    def _fetch_cached(self, job, kind):
+        """
+        Fills the job's output from the rendition cache if it can.  Returns the
+        cache key to store the new rendition under, or None on a hit or when
+        there is no cache.
+        """
+        if self._cache is None:
+            return None
+        key = self._cache.key(job['full_path'], self._rendition_params(kind))
+        if self._cache.fetch(key, job['output']):
+            return None
+        return key
+
+    def work_queue(self, kind):
+        """
+        Claims and processes jobs of one kind from the distributed queue until
+        none are left unfinished on any host.  Waits while other hosts still
+        hold leases, in case one of them dies and its jobs come back.
+
+        :param kind: 'photo' or 'video'.
+        :return: List of (job, record) for the jobs processed here.
+        """
+        if kind == 'video':
+            process = self.convert_video
+        else:
+            process = self.resync_image if self._resync else self.resize_image
+        results = []
+        while True:
+            claimed = self._queue.claim(kind)
+            if claimed is None:
+                if not self._queue.unfinished(kind):
+                    return results
+                time.sleep(self._queue.poll_interval)
+                continue
+            job_id, job = claimed
+            sample = self._queue.run(job_id, process, job)
+            self._queue.finish(job_id, sample['status'] == 'ok', sample['transient'])
+            if sample['status'] == 'ok':
+                self._adjust_timestamp(job)
+            results.append((job, sample))
+
+    @staticmethod
+    def _adjust_timestamp(job):
+        "Gives the output the modification time of its source."
+        stinfo = os.stat(job['output'])
+        os.utime(job['output'], (stinfo.st_atime, job['timestamp_modified']))
+
+    def _embedded_preview(self, metadata, source):
+        """
+        Returns the smallest embedded preview that still covers the rendition
+        size as an opened image, or None when no preview is big enough.
+        Previews with a different aspect ratio are letterboxed, so they are
+        skipped too.  Previews seldom carry an ICC profile, they get the
+        source's so the sRGB conversion still happens.
+
+        :param metadata: GExiv2 Metadata of the source photo.
+        :param source: Path of the source photo.
+        """
+        width, height = metadata.get_pixel_width(), metadata.get_pixel_height()
+        if not width or not height:
+            return None
+        wanted = fit_size((width, height), self._default_size)
+        candidates = [
+            properties for properties in metadata.get_preview_properties()
+            if properties.get_width() >= wanted[0] and properties.get_height() >= wanted[1]
+            and abs(properties.get_width() / properties.get_height() - width / height) < 0.01
+        ]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda properties: properties.get_width())
+        logging.debug(f"Using the {best.get_width()}x{best.get_height()} embedded preview.")
+        data = metadata.get_preview_image(best).get_data()
+        preview = Image.open(io.BytesIO(data))
+        if not preview.info.get('icc_profile'):
+            try:
+                with Image.open(source) as original:
+                    # A CMYK source's profile doesn't fit an RGB preview.
+                    profile = original.info.get('icc_profile') if original.mode == preview.mode else None
+            except OSError:
+                profile = None
+            if profile:
+                preview.info['icc_profile'] = profile
+        return preview
+
+    def _encode_jpeg(self, im, metadata_bytes=0, **options):
+        """
+        Encodes the resized photo, searching for the quality when a target size
+        or SSIM is set.
+
+        :param metadata_bytes: What the metadata copied in afterwards adds to
+                               the file, taken off the target size.
+        """
+        options['icc_profile'] = im.info.get('icc_profile')
+        if not (self._target_size or self._target_ssim):
+            return encode_jpeg(im, **options)
+        max_bytes = None
+        if self._target_size:
+            max_bytes = max(self._target_size - metadata_bytes, 1)
+        quality, data = search_jpeg_quality(im, max_bytes, self._target_ssim, **options)
+        logging.info(f"Encoded at quality {quality}, {len(data)} bytes.")
+        return data
+
+    def _downsize(self, im):
+        """
+        Fits an opened image in the target size.  Images too big to decode
+        within the memory limit are streamed in bands when their format allows.
+        """
+        if im.size[0] * im.size[1] * 4 > self._max_memory:
+            reduced = banded_thumbnail(im, self._default_size, self._max_memory)
+            if reduced is not None:
+                return reduced
+            if im.size[0] * im.size[1] > 2 * PIXEL_LIMIT:
+                raise Image.DecompressionBombError(
+                    f"{im.size[0]}x{im.size[1]} pixels can't be read in bands and are too many to decode whole.")
+            logging.warning(f"{bcolors.WARNING}{getattr(im, 'filename', 'Image')} can't be read in bands, decoding it whole.{bcolors.ENDC}")
+        im.thumbnail(self._default_size, Image.Resampling.LANCZOS)
+        return im
 
     def resize_image(self, photo):
         """
@@ -114,37 +2087,184 @@ class MediaResizer:
                     "mime_type": source mime_type,
                     "timestamp_accessed": source stinfo.st_atime,
                     "timestamp_modified": source stinfo.st_mtime,
+                    "input_bytes": source stinfo.st_size,
                     "output": output file with full path
+
+        :return: Result record from job_record.
         """
+        timer = StageTimer()
         try:
             print(f"{bcolors.OKCYAN}Processing file {photo['input']} now.{bcolors.ENDC}")
-            im = Image.open(photo['full_path'])
-            metadata = Metadata(photo['full_path'])
-            if not os.path.exists(self._new_folder):
-                os.makedirs(self._new_folder)
+            if self._archive_format:
+                data, cached = self._encode_photo(photo, timer)
+                output_size = Image.open(io.BytesIO(data)).size
+                return job_record('photo', photo, timer, action='cached' if cached else 'rendered',
+                                  output_bytes=len(data), output_width=output_size[0],
+                                  output_height=output_size[1], data=data)
+            os.makedirs(self._new_folder, exist_ok=True)
             outfile = photo['output']
+            cache_key = self._fetch_cached(photo, 'photo')
+            timer.lap('cache')
+            if self._cache and cache_key is None:
+                # The manifest has to describe this source, not whatever was
+                # rendered to the output before.
+                hashes = self._source_hashes(photo, Metadata(photo['full_path']))
+                timer.lap('hash')
+                return self._photo_record(photo, timer, action='cached', hashes=hashes)
+            metadata = Metadata(photo['full_path'])
+            im = self._embedded_preview(metadata, photo['full_path']) if self._use_previews else None
+            if im is None:
+                im = Image.open(photo['full_path'])
+            timer.lap('open')
             logging.info(f"{bcolors.OKGREEN}Creating file for {outfile}{bcolors.ENDC}")
-            im.thumbnail(self._default_size, Image.Resampling.LANCZOS)
-            im.save(outfile, 'jpeg')
-            # TODO(jreuter): Split this out to a function.
-            outfile_metadata = Metadata(outfile)
-            # We check for Tiff images.  If found, don't save comment data.
-            if metadata.get_mime_type() == 'image/tiff':
-                # TODO (jreuter): See if we really need this.  I can't remember what we did differently with TIFF.
-                # params: destination, exif=True, iptc=True,
-                # xmp=True, comment=True
-                # metadata.copy(outfile_metadata, True, True, True, False)
-                # save all exif data of orinal image to resized
-                for tag in metadata.get_exif_tags():
-                    logging.info("setting tag {} in file {}.".format(tag, outfile))
-                    outfile_metadata[tag] = metadata[tag]
+            im = self._downsize(im)
+            timer.lap('decode_resize')
+            if self._color_management:
+                im = convert_to_srgb(im, self._intent)
+                timer.lap('color')
+            metadata_bytes = self._metadata_overhead(metadata) if self._target_size else 0
+            # Encode before touching the old output, so a failure leaves it be.
+            data = self._encode_jpeg(im, metadata_bytes)
+            # The old output may be hardlinked to a cache entry, write a new
+            # file rather than into the shared one.
+            if os.path.lexists(outfile):
+                os.remove(outfile)
+            with open(outfile, 'wb') as output:
+                output.write(data)
+            timer.lap('encode')
+            self._copy_metadata(metadata, outfile)
+            timer.lap('metadata')
+            if cache_key:
+                self._cache.store(cache_key, outfile)
+            hashes = self._source_hashes(photo, metadata)
+            timer.lap('hash')
+        except Exception as ex:
+            return failed_record('photo', photo, timer, ex)
+        return self._photo_record(photo, timer, hashes=hashes)
+
+    @staticmethod
+    def _photo_record(photo, timer, **fields):
+        "Returns the record of a photo whose output file is in place."
+        with Image.open(photo['output']) as output:
+            width, height = output.size
+        return job_record('photo', photo, timer, output_bytes=os.path.getsize(photo['output']),
+                          output_width=width, output_height=height, **fields)
+
+    @staticmethod
+    def _copy_metadata(metadata, outfile):
+        """
+        Replaces the EXIF, IPTC and XMP of outfile with the source's.
+
+        :param metadata: GExiv2 Metadata of the source photo.
+        :param outfile: Path of the output photo.
+        """
+        outfile_metadata = Metadata(outfile)
+        outfile_metadata.clear_exif()
+        outfile_metadata.clear_iptc()
+        outfile_metadata.clear_xmp()
+        # TODO (jreuter): See if we really need this.  I can't remember what we did differently with TIFF.
+        # TIFF sources used to skip comment data, params: destination,
+        # exif=True, iptc=True, xmp=True, comment=True
+        # metadata.copy(outfile_metadata, True, True, True, False)
+        for tag in metadata.get_exif_tags():
+            logging.info("setting tag {} in file {}.".format(tag, outfile))
+            outfile_metadata[tag] = metadata[tag]
+        for tag in metadata.get_iptc_tags() + metadata.get_xmp_tags():
+            logging.info("setting tag {} in file {}.".format(tag, outfile))
+            try:
+                outfile_metadata.set_tag_multiple(tag, metadata.get_tag_multiple(tag))
+            except GLib.Error as ex:
+                logging.warning(f"{bcolors.WARNING}Cannot copy tag {tag} to {outfile}: {ex}{bcolors.ENDC}")
+        outfile_metadata.save_file(outfile)
+
+    def _metadata_overhead(self, metadata):
+        """
+        Returns how many bytes copying the source's metadata adds to a JPEG,
+        maker notes and EXIF thumbnail included, by copying it onto a blank one.
+        """
+        fd, path = tempfile.mkstemp(suffix='.jpg', dir=self._new_folder)
+        try:
+            with os.fdopen(fd, 'wb') as blank:
+                blank.write(encode_jpeg(Image.new('L', (8, 8))))
+            bare = os.path.getsize(path)
+            self._copy_metadata(metadata, path)
+            return os.path.getsize(path) - bare
+        finally:
+            os.unlink(path)
+
+    def _source_hashes(self, photo, metadata):
+        "Returns the digests --resync compares a photo's source against."
+        return {
+            "pixels": pixel_digest(photo['full_path']),
+            "metadata": metadata_digest(metadata),
+            "params": json.dumps(self._rendition_params('photo'), sort_keys=True),
+        }
+
+    def resync_image(self, photo):
+        """
+        Brings a photo output up to date with the least work: nothing if the
+        source is unchanged, only its metadata blocks if just the source's
+        metadata changed, otherwise a full resize_image.
+
+        :param photo: Job dict as for resize_image, plus "previous" with the
+                      digests of the source the output was made from.
+        """
+        timer = StageTimer()
+        previous = photo.get('previous')
+        outfile = photo['output']
+        if previous is None or not os.path.exists(outfile):
+            return self.resize_image(photo)
+        try:
+            metadata = Metadata(photo['full_path'])
+            hashes = self._source_hashes(photo, metadata)
+            timer.lap('hash')
+            if (hashes['pixels'], hashes['params']) != (previous['pixels'], previous['params']):
+                return self.resize_image(photo)
+            if hashes['metadata'] == previous['metadata']:
+                action = 'unchanged'
             else:
-                for tag in metadata.get_exif_tags():
-                    logging.info("setting tag {} in file {}.".format(tag, outfile))
-                    outfile_metadata[tag] = metadata[tag]
-            outfile_metadata.save_file(outfile)
-        except IOError:
-            logging.error(f"{bcolors.FAIL}Cannot create new image for {photo['input']}{bcolors.ENDC}")
+                print(f"{bcolors.OKCYAN}Updating metadata of {photo['input']}.{bcolors.ENDC}")
+                if os.stat(outfile).st_nlink > 1:
+                    # Don't edit a file shared with the rendition cache.
+                    shutil.copy2(outfile, outfile + '.tmp')
+                    os.replace(outfile + '.tmp', outfile)
+                self._copy_metadata(metadata, outfile)
+                timer.lap('metadata')
+                action = 'resynced'
+        except Exception as ex:
+            return failed_record('photo', photo, timer, ex)
+        return self._photo_record(photo, timer, hashes=hashes, action=action)
+
+    def _encode_photo(self, photo, timer):
+        """
+        Resizes a photo to JPEG bytes in memory for the archive writer.  The
+        EXIF block is carried over by Pillow since GExiv2 can only save to
+        files.
+
+        :return: Tuple of (JPEG bytes, whether they came from the cache).
+        """
+        cache_key = None
+        if self._cache:
+            cache_key = self._cache.key(photo['full_path'], self._rendition_params('photo'))
+            data = self._cache.read(cache_key)
+            if data is not None:
+                return data, True
+        timer.lap('cache')
+        im = Image.open(photo['full_path'])
+        exif = im.getexif()
+        if self._use_previews:
+            im = self._embedded_preview(Metadata(photo['full_path']), photo['full_path']) or im
+        timer.lap('open')
+        im = self._downsize(im)
+        timer.lap('decode_resize')
+        if self._color_management:
+            im = convert_to_srgb(im, self._intent)
+            timer.lap('color')
+        data = self._encode_jpeg(im, exif=exif)
+        timer.lap('encode')
+        if cache_key:
+            self._cache.store_bytes(cache_key, data)
+        return data, False
 
     def convert_video(self, video):
         """
@@ -158,45 +2278,207 @@ class MediaResizer:
                     "timestamp_accessed": source stinfo.st_atime,
                     "timestamp_modified": source stinfo.st_mtime,
                     "output": output file with full path
+
+        :return: Result record from job_record.
         """
+        timer = StageTimer()
+        stats = {}
+        posters = None
         try:
             print(f"{bcolors.OKCYAN}Processing file {video['input']} now.{bcolors.ENDC}")
             cores_to_use = max(cpu_count()-2, 1)
             thread_count = f"threads={cores_to_use}"
-            if not os.path.exists(self._new_folder):
-                os.makedirs(self._new_folder)
+            os.makedirs(self._new_folder, exist_ok=True)
+            if self._posters:
+                posters = self._start_posters(video)
+            cache_key = self._fetch_cached(video, 'video')
+            timer.lap('cache')
+            if self._cache and cache_key is None:
+                return job_record('video', video, timer, action='cached',
+                                  output_bytes=os.path.getsize(video['output']),
+                                  **(posters() if posters else {}))
             handbrake_command = [
                 os.path.join(os.path.sep, 'usr', 'bin', 'HandBrakeCLI'),
                 '-v',
                 '-x', thread_count,
-                '-e', 'x264',
-                '-t', '1',
-                '--h264-profile', 'main',
-                '--x264-preset', 'slower',
-                '--quality', '21',
+                *self._handbrake_settings,
                 '-i', video['full_path'],
                 '-o', video['output']
             ]
             logging.info(f"cmd is {handbrake_command}")
             logging.debug(f"Creating file {video['output']}")
-            handbrake = subprocess.Popen(
-                handbrake_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            out, err = handbrake.communicate()
-            # TODO (jreuter): See if there's a way to add this back and not get errors that aren't really errors.
-            # if handbrake.returncode or err:
-                # Handbrake is returning errors that aren't really errors and I can't figure out an option to stop it.
-                # logging.error('Error from Handbrake %s.' % err)
-                # return
+            # Don't let HandBrake write into an output shared with the cache.
+            if os.path.lexists(video['output']):
+                os.remove(video['output'])
+            returncode, out, err, stats = run_measured(handbrake_command)
+            timer.lap('encode')
+            self._log_subprocess(stats, video)
+            # Handbrake writes plenty to stderr that isn't really an error, so
+            # only the return code and the output decide whether it worked.
+            if returncode or not os.path.exists(video['output']):
+                tail = err.decode(errors='replace')[-400:].strip()
+                raise SubprocessError(f"HandBrakeCLI exited with {returncode}: {tail}", returncode)
+            if cache_key:
+                self._cache.store(cache_key, video['output'])
             logging.info(f"Done with video: {video['output']}")
-        except OSError as ex:
-            logging.error(f"{bcolors.FAIL}OS Error: {ex}{bcolors.ENDC}")
-        except IOError:
-            logging.error(f"{bcolors.FAIL}Cannot create new video for {video['input']}{bcolors.ENDC}")
+        except Exception as ex:
+            return failed_record('video', video, timer, ex, returncode=stats.get('returncode'),
+                                 max_rss=stats.get('max_rss'), **(posters() if posters else {}))
+        extra = {}
+        if posters:
+            extra = posters()
+            timer.lap('posters')
+        # HandBrake's own cpu time is what a video costs, not this process's.
+        return job_record('video', video, timer, cpu=stats['cpu'],
+                          output_bytes=os.path.getsize(video['output']),
+                          output_width=video.get('width', 0), output_height=video.get('height', 0),
+                          returncode=stats['returncode'], max_rss=stats['max_rss'], **extra)
 
-    def do_converstion(self, files):
+    def _grab_frames(self, video, times):
+        """
+        Yields one frame per time from a single ffmpeg run.  Every time is its
+        own input seeked with -ss, and only keyframes are decoded, so ffmpeg
+        reads a few packets around each time instead of the whole file.
+        Frames come back as raw RGB at the stored size and are rotated here.
+        """
+        width, height = video['width'], video['height']
+        command = [os.path.join(os.path.sep, 'usr', 'bin', 'ffmpeg'),
+                   '-nostdin', '-loglevel', 'error']
+        for seconds in times:
+            command += ['-noautorotate', '-skip_frame', 'nokey', '-noaccurate_seek',
+                        '-ss', f"{seconds:.3f}", '-i', video['full_path']]
+        graph = ''.join(f"[{index}:v:0]trim=end_frame=1,scale={width}:{height},setsar=1[f{index}];"
+                        for index in range(len(times)))
+        graph += ''.join(f"[f{index}]" for index in range(len(times)))
+        graph += f"concat=n={len(times)}:v=1:a=0,format=rgb24[frames]"
+        command += ['-filter_complex', graph, '-map', '[frames]', '-frames:v', str(len(times)),
+                    '-f', 'rawvideo', '-']
+        logging.debug(f"cmd is {command}")
+        frame_size = width * height * 3
+        transpose = {90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180,
+                     270: Image.Transpose.ROTATE_90}.get(video.get('rotation', 0))
+        wall_start = time.perf_counter()
+        ffmpeg = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for _ in times:
+                data = ffmpeg.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                frame = Image.frombytes('RGB', (width, height), data)
+                yield frame.transpose(transpose) if transpose is not None else frame
+        finally:
+            ffmpeg.stdout.close()
+            err = ffmpeg.stderr.read()
+            self._log_subprocess(reap_measured(ffmpeg, command, wall_start), video)
+            if ffmpeg.returncode > 0:
+                raise SubprocessError(f"ffmpeg exited with {ffmpeg.returncode}: "
+                                      f"{err.decode(errors='replace')[-400:].strip()}", ffmpeg.returncode)
+
+    def _log_subprocess(self, stats, job):
+        "Adds the stats of a helper program run to subprocesses.jsonl under --profile."
+        if self._profile_dir:
+            with open(os.path.join(self._profile_dir, 'subprocesses.jsonl'), 'a') as log:
+                log.write(json.dumps(dict(stats, input=job['input'])) + '\n')
+
+    def make_posters(self, video):
+        """
+        Writes a poster frame and a contact sheet for a video.  The frames go
+        through the same resize and JPEG encoding as photos.
+
+        :return: List of the files written.
+        """
+        if not (video['width'] and video['height'] and video['duration']):
+            raise MediaResizerException(f"No frame size or duration known for {video['input']}.")
+        columns, rows = self._sheet_grid
+        count = columns * rows
+        # Skip into the video for the poster, openings are often black.
+        times = [video['duration'] * 0.1]
+        times += [video['duration'] * (index + 0.5) / count for index in range(count)]
+        frames = self._grab_frames(video, times)
+        poster = next(frames, None)
+        if poster is None:
+            raise MediaResizerException(f"ffmpeg returned no frames for {video['input']}.")
+        data = self._encode_jpeg(self._downsize(poster))
+        with open(video['poster'], 'wb') as output:
+            output.write(data)
+        tile_width, tile_height = self._sheet_tile
+        sheet = Image.new('RGB', (tile_width * columns, tile_height * rows))
+        for index, frame in enumerate(frames):
+            frame.thumbnail(self._sheet_tile, Image.Resampling.LANCZOS)
+            left = index % columns * tile_width + (tile_width - frame.width) // 2
+            top = index // columns * tile_height + (tile_height - frame.height) // 2
+            sheet.paste(frame, (left, top))
+        data = self._encode_jpeg(sheet)
+        with open(video['contact_sheet'], 'wb') as output:
+            output.write(data)
+        return [video['poster'], video['contact_sheet']]
+
+    def _start_posters(self, video):
+        """
+        Starts make_posters on a thread so it reads the source while HandBrake
+        has it warm in the page cache.  Returns a function that waits for it
+        and returns the fields to add to the video's record.
+        """
+        outcome = {}
+
+        def run():
+            try:
+                outcome['posters'] = self.make_posters(video)
+            except Exception as ex:
+                logging.warning(f"{bcolors.WARNING}Cannot make posters for {video['input']}: {ex}{bcolors.ENDC}")
+                outcome['poster_error'] = f"{type(ex).__name__}: {ex}"[:500]
+
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        def wait():
+            thread.join()
+            return outcome
+        return wait
+
+    def _probe_photo(self, photo):
+        """
+        Adds the pixel size of a photo from its header, without decoding it.
+        """
+        try:
+            with Image.open(photo['full_path']) as im:
+                photo['width'], photo['height'] = im.size
+        except Exception as ex:
+            # Pillow raises more than OSError for headers it refuses, and
+            # one bad file mustn't stop the folder before any work starts.
+            logging.warning(f"{bcolors.WARNING}Cannot read the header of {photo['input']}: {ex}{bcolors.ENDC}")
+            photo['width'], photo['height'] = 0, 0
+        photo['box'] = self._default_size
+
+    def _probe_video(self, video):
+        """
+        Adds duration, frame size and codec of a video from its container,
+        without decoding it.
+        """
+        video['duration'], video['width'], video['height'], video['rotation'] = 0, 0, 0, 0
+        video['codec'] = 'unknown'
+        try:
+            tracks = MediaInfo.parse(video['full_path']).video_tracks
+        except Exception as ex:
+            # An unreadable container or a missing libmediainfo mustn't stop
+            # the folder before any work starts.
+            logging.warning(f"{bcolors.WARNING}Cannot read the container of {video['input']}: {ex}{bcolors.ENDC}")
+            return
+        if not tracks:
+            logging.warning(f"{bcolors.WARNING}No video track found in {video['input']}{bcolors.ENDC}")
+            return
+        track = tracks[0]
+        video['duration'] = float(track.duration or 0) / 1000
+        video['width'] = int(track.width or 0)
+        video['height'] = int(track.height or 0)
+        video['codec'] = track.format or 'unknown'
+        video['rotation'] = int(float(track.rotation or 0)) % 360
+
+    def collect_media(self, files):
+        """
+        Sorts the files into photos and videos by mime type and probes each of
+        them.  Returns the two lists of job dicts.
+        """
         videos = []  # os.path.join(self._new_folder, name + '_compressed' + '.m4v')
         photos = []  # os.path.join(self._new_folder, name + '_' + self._size_string + '.JPG')
         for file in files:
@@ -213,6 +2495,7 @@ class MediaResizer:
                     "mime_type": mime_type,
                     "timestamp_accessed": stinfo.st_atime,
                     "timestamp_modified": stinfo.st_mtime,
+                    "input_bytes": stinfo.st_size,
                     "output": os.path.join(self._new_folder, name + '_' + self._size_string + '.JPG')
                 })
             elif mime_type.startswith('video'):
@@ -222,35 +2505,253 @@ class MediaResizer:
                     "mime_type": mime_type,
                     "timestamp_accessed": stinfo.st_atime,
                     "timestamp_modified": stinfo.st_mtime,
-                    "output": os.path.join(self._new_folder, name + '_compressed' + '.m4v')
+                    "input_bytes": stinfo.st_size,
+                    "output": os.path.join(self._new_folder, name + '_compressed' + '.m4v'),
+                    "poster": os.path.join(self._new_folder, name + '_poster' + '.JPG'),
+                    "contact_sheet": os.path.join(self._new_folder, name + '_contact' + '.JPG')
                 })
             elif mime_type == 'application/octet-stream':
                 print(f"{bcolors.WARNING}Not processing file {file}.{bcolors.ENDC}")
+        for photo in photos:
+            self._probe_photo(photo)
+        for video in videos:
+            self._probe_video(video)
+        return photos, videos
+
+    def plan(self, files):
+        """
+        Prints the estimated cpu time, wall time and output size of each file
+        and of the whole run, without processing anything.
+        """
+        photos, videos = self.collect_media(files)
+        costs = CostModel(self._arguments['--costs'])
+        photo_totals = [0, 0, 0]
+        video_totals = [0, 0, 0]
+        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Planned work.{bcolors.ENDC}")
+        for jobs, estimate, totals in ((photos, costs.estimate_photo, photo_totals),
+                                       (videos, costs.estimate_video, video_totals)):
+            for job in jobs:
+                cpu, wall, size = estimate(job)
+                totals[0] += cpu
+                totals[1] += wall
+                totals[2] += size
+                print(f"{job['input']}: {human_seconds(cpu)} cpu, {human_bytes(size)}")
+        # Photos spread over the pool, videos run one after the other.
+        workers = min(self._workers, max(len(photos), 1))
+        wall = photo_totals[1] / workers + video_totals[1]
+        print(f"\n{bcolors.BOLD}{len(photos)} photos, {len(videos)} videos{bcolors.ENDC}")
+        print(f"CPU time:  {human_seconds(photo_totals[0] + video_totals[0])}")
+        print(f"Wall time: {human_seconds(wall)} with {self._workers} photo workers")
+        print(f"Output:    {human_bytes(photo_totals[2] + video_totals[2])}")
+
+    def _finish_job(self, job, sample, record, adjust=True):
+        """
+        Wraps up a finished job in the main process: sets the output's
+        timestamp, records its cost and hands it to the uploader.
+        """
+        self._report.add(sample)
+        if sample['status'] != 'ok':
+            return
+        # Only real renders say anything about what a render costs.
+        if sample.get('action', 'rendered') == 'rendered':
+            record(job, sample)
+        if 'data' in sample:
+            self._archive.add(os.path.basename(job['output']), sample['data'],
+                              job['timestamp_modified'])
+            return
+        if 'hashes' in sample and self._manifest:
+            self._manifest.put(os.path.basename(job['output']), sample['hashes'])
+        if adjust:
+            self._adjust_timestamp(job)
+        if self._uploader and sample.get('action') != 'unchanged':
+            self._uploader.submit(job['output'])
+            for poster in sample.get('posters', []):
+                self._uploader.submit(poster)
+
+    def distributed_conversion(self, photos, videos, costs):
+        """
+        Queues this folder's jobs on the shared queue and works through it
+        alongside any other hosts doing the same.
+        """
+        for kind, jobs in (('photo', photos), ('video', videos)):
+            self._queue.enqueue(kind, jobs, {'rendition': self._rendition_params(kind),
+                                             'resync': self._resync})
+        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Processing queued photos.{bcolors.ENDC}")
+        pool = Pool(self._workers, limit_cpu)
+        photo_results = pool.map(unwrap_self_queue, [(self, 'photo')] * self._workers)
+        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Processing queued videos.{bcolors.ENDC}")
+        video_results = unwrap_self_queue((self, 'video'))
+        for results in photo_results:
+            for photo, sample in results:
+                self._finish_job(photo, sample, costs.record_photo, adjust=False)
+        for video, sample in video_results:
+            self._finish_job(video, sample, costs.record_video, adjust=False)
+
+    def do_converstion(self, files):
+        photos, videos = self.collect_media(files)
+        if self._disk_order:
+            photos, videos = order_by_disk(photos), order_by_disk(videos)
+        costs = CostModel(self._arguments['--costs'])
+        if not self._archive_format:
+            self._manifest = Manifest(os.path.join(self._new_folder, '.manifest.sqlite'))
+            if self._resync:
+                for photo in photos:
+                    photo['previous'] = self._manifest.get(os.path.basename(photo['output']))
+        self._report = RunReport(self._folder)
+        if self._queue:
+            self.distributed_conversion(photos, videos, costs)
+        elif self._autoscale:
+            self._convert_autoscaled(photos, videos, costs)
+        else:
+            self._convert_photos(photos, costs)
+            self._convert_videos(videos, costs)
+        costs.save()
+        if self._cache:
+            self._cache.evict()
+        self._report.write(self._arguments['--report']
+                           or os.path.join(self._new_folder, 'report.json'))
+        self._report.print_summary()
+
+    def _retry_list(self, jobs):
+        "Returns the jobs that failed transiently and may be tried again."
+        retry = [job for job in jobs if self._report.should_retry(job, self._retries)]
+        if retry:
+            print(f"\n{bcolors.WARNING}Retrying {len(retry)} failed jobs.{bcolors.ENDC}")
+        return retry
 
+    def _convert_photos(self, photos, costs):
         print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Processing Photos.{bcolors.ENDC}")
         # Loop through file list for processing.
-        pool = Pool(max(cpu_count() - 2, 1), limit_cpu)
-        results = pool.map(unwrap_self_photos, list(zip([self] * len(photos), photos)))
+        self._open_archive()
+        readahead = ReadAhead(photos, self._readahead, self._workers) if self._readahead else None
+        pool = Pool(self._workers, limit_cpu)
+        # imap hands back each photo as it is done so it can go to the uploader
+        # while the rest are still being resized.
+        results = pool.imap(unwrap_self_photos, list(zip([self] * len(photos), photos)))
+        for index, (photo, sample) in enumerate(zip(photos, results)):
+            if readahead:
+                readahead.done(index)
+            self._finish_job(photo, sample, costs.record_photo)
+        if readahead:
+            readahead.close()
+        retry = self._retry_list(photos)
+        while retry:
+            results = pool.imap(unwrap_self_photos, list(zip([self] * len(retry), retry)))
+            for photo, sample in zip(retry, results):
+                self._finish_job(photo, sample, costs.record_photo)
+            retry = self._retry_list(retry)
+        pool.close()
+        self._close_archive()
 
-        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Adjusting photo timestamps.{bcolors.ENDC}")
-        for photo in photos:
-            stinfo = os.stat(photo['output'])
-            os.utime(photo['output'], (stinfo.st_atime, photo['timestamp_modified']))
+    def _open_archive(self):
+        if self._archive_format:
+            self._archive = ArchiveWriter(f"{self._new_folder}.{self._archive_format}",
+                                          self._archive_format)
 
+    def _close_archive(self):
+        if self._archive:
+            index = self._archive.close()
+            if self._uploader:
+                self._uploader.submit(self._archive.path)
+                self._uploader.submit(index)
+
+    def _convert_videos(self, videos, costs):
         print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Processing Videos.{bcolors.ENDC}")
         # Loop through file list for processing.
         queue = Queue()
-        for video in videos:
-            queue.put(video)
+        for item in enumerate(videos):
+            queue.put(item)
         queue.put(None)
-        video_process = Process(target=self.consume_video, args=(queue,))
+        results = Queue()
+        video_process = Process(target=self.consume_video, args=(queue, results))
         video_process.start()
+        # Drain the results before joining so the consumer never blocks.
+        for _ in videos:
+            index, record = results.get()
+            self._finish_job(videos[index], record, costs.record_video)
         video_process.join()
+        retry = self._retry_list(videos)
+        while retry:
+            for video in retry:
+                self._finish_job(video, self.convert_video(video), costs.record_video)
+            retry = self._retry_list(retry)
 
-        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Adjusting video timestamps.{bcolors.ENDC}")
-        for video in videos:
-            stinfo = os.stat(video['output'])
-            os.utime(video['output'], (stinfo.st_atime, video['timestamp_modified']))
+    def _convert_autoscaled(self, photos, videos, costs):
+        """
+        Works on the photos and videos at the same time, handing out only as
+        many of each as the Autoscaler allows at the moment.  The pool and the
+        video consumers start at their ceilings and wait for work while the
+        limits are lower.  Jobs that failed transiently go to the back of
+        their queue.
+        """
+        print(f"\n{bcolors.UNDERLINE}{bcolors.OKGREEN}Processing Photos and Videos.{bcolors.ENDC}")
+        self._open_archive()
+        scaler = Autoscaler(self._workers, self._min_workers, self._max_workers,
+                            self._max_videos, float(self._arguments['--scale-interval']))
+        readahead = ReadAhead(photos, self._readahead, scaler.photos) if self._readahead else None
+        pool = Pool(self._max_workers, limit_cpu)
+        video_queue, video_results = Queue(), Queue()
+        consumers = [Process(target=self.consume_video, args=(video_queue, video_results))
+                     for _ in range(min(self._max_videos, len(videos)))]
+        for consumer in consumers:
+            consumer.start()
+        # Photos and videos finish into one queue, the videos through a thread
+        # reading the consumers' results.
+        finished = SimpleQueue()
+
+        def forward_videos():
+            for index, record in iter(video_results.get, None):
+                finished.put(('video', index, record))
+        forwarder = threading.Thread(target=forward_videos, daemon=True)
+        forwarder.start()
+
+        jobs = {'photo': photos, 'video': videos}
+        pending = {'photo': deque(range(len(photos))), 'video': deque(range(len(videos)))}
+        running = {'photo': 0, 'video': 0}
+        while any(pending.values()) or any(running.values()):
+            while pending['photo'] and running['photo'] < scaler.photos:
+                index = pending['photo'].popleft()
+                photo = photos[index]
+                pool.apply_async(
+                    unwrap_self_photos, ((self, photo),),
+                    callback=lambda record, index=index: finished.put(('photo', index, record)),
+                    error_callback=lambda ex, index=index, photo=photo: finished.put(
+                        ('photo', index, failed_record('photo', photo, StageTimer(), ex))))
+                running['photo'] += 1
+            while pending['video'] and running['video'] < scaler.videos:
+                index = pending['video'].popleft()
+                video_queue.put((index, videos[index]))
+                running['video'] += 1
+            scaler.backlog = len(pending['photo'])
+            try:
+                kind, index, record = finished.get(timeout=1)
+            except Empty:
+                # Nothing finished, but the limits may have grown.
+                continue
+            running[kind] -= 1
+            job = jobs[kind][index]
+            if kind == 'photo':
+                scaler.finished(record)
+                if readahead:
+                    readahead.in_flight = scaler.photos
+                    readahead.done(index)
+                self._finish_job(job, record, costs.record_photo)
+            else:
+                self._finish_job(job, record, costs.record_video)
+            if self._report.should_retry(job, self._retries):
+                print(f"\n{bcolors.WARNING}Retrying {job['input']}.{bcolors.ENDC}")
+                pending[kind].append(index)
+        for _ in consumers:
+            video_queue.put(None)
+        for consumer in consumers:
+            consumer.join()
+        video_results.put(None)
+        forwarder.join()
+        pool.close()
+        scaler.close()
+        if readahead:
+            readahead.close()
+        self._close_archive()
 
     def main(self):
         """
@@ -274,14 +2775,34 @@ class MediaResizer:
         self._size_string = str(self._default_size[0]) + \
                           'x' + str(self._default_size[1])
         self._new_folder = os.path.join(self._folder, 'resized_' + self._size_string)
-        if not os.path.exists(self._new_folder):
-            os.makedirs(self._new_folder)
 
         # Get all files in the directory, but only files.
         files = [f for f in os.listdir(self._folder)
                  if os.path.isfile(os.path.join(self._folder, f))]
 
-        self.do_converstion(files)
+        if self._arguments['--plan']:
+            self.plan(files)
+            return
+
+        os.makedirs(self._new_folder, exist_ok=True)
+        if self._arguments['--distributed']:
+            self._queue = JobQueue(os.path.join(self._new_folder, '.queue.sqlite'),
+                                   int(self._arguments['--lease']), self._folder)
+        if self._arguments['--upload']:
+            self._uploader = Uploader(self._arguments['--upload'],
+                                      os.path.dirname(os.path.abspath(self._folder)),
+                                      int(self._arguments['--upload-jobs']),
+                                      int(self._arguments['--upload-retries']))
+        if self._arguments['--profile']:
+            self._profile_dir = os.path.join(self._folder, 'profile_' + self._size_string)
+            shutil.rmtree(self._profile_dir, ignore_errors=True)
+            os.makedirs(self._profile_dir)
+            profiled(self._profile_dir, self.do_converstion, files)
+            merge_profiles(self._profile_dir)
+        else:
+            self.do_converstion(files)
+        if self._uploader:
+            self._uploader.close()
         print(f"{bcolors.OKGREEN}Finished processing media.{bcolors.ENDC}")
 
 
@@ -0,0 +1,90 @@
+"""
+Checks that photos read in bands decode to the same pixels as a full decode.
+"""
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import mediaResizer  # noqa: E402
+
+
+def noise(mode, size):
+    "Returns a noisy image, so the PNG encoder uses every row filter."
+    bands = [Image.effect_noise(size, 64 + 16 * index) for index in range(len(mode))]
+    if mode == 'I;16':
+        return bands[0].convert('I').point(lambda value: value * 257).convert('I;16')
+    return Image.merge(mode, bands)
+
+
+def write_png(path, size, bit_depth, color_type, raw):
+    "Writes raw filtered rows as a PNG, for layouts Pillow doesn't save."
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data
+                + struct.pack('>I', zlib.crc32(chunk_type + data)))
+    header = struct.pack('>IIBBBBB', size[0], size[1], bit_depth, color_type, 0, 0, 0)
+    with open(path, 'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+                  + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+class BandedReadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name)
+
+    def assert_bands_match(self, path, rows=7):
+        with Image.open(path) as im:
+            bands = mediaResizer._band_reader(im)
+            self.assertIsNotNone(bands)
+            stitched = Image.new(im.mode, im.size)
+            for top, band in bands(im, rows):
+                stitched.paste(band, (0, top))
+        with Image.open(path) as full:
+            self.assertEqual(stitched.tobytes(), full.tobytes())
+
+    def test_png_bands_match_full_decode(self):
+        for mode in ('L', 'LA', 'RGB', 'RGBA', 'I;16'):
+            with self.subTest(mode=mode):
+                noise(mode, (61, 50)).save(self.path(f"{mode}.png"))
+                self.assert_bands_match(self.path(f"{mode}.png"))
+
+    def test_tiff_bands_match_full_decode(self):
+        for mode in ('L', 'RGB', 'I;16'):
+            with self.subTest(mode=mode):
+                noise(mode, (61, 50)).save(self.path(f"{mode}.tif"), rowsperstrip=5)
+                self.assert_bands_match(self.path(f"{mode}.tif"))
+
+    def test_png_layouts_that_need_a_full_decode(self):
+        width, height = 9, 6
+        # 16 bit RGB with the Up filter, which needs the exact previous row.
+        row = b'\x02' + bytes(range(width * 6))
+        write_png(self.path('rgb16.png'), (width, height), 16, 2, row * height)
+        # 4 bit grey, whose rows end in half a byte.
+        row = b'\x00' + bytes(range(0, 256, 51))
+        write_png(self.path('grey4.png'), (width, height), 4, 0, row * height)
+        for name in ('rgb16.png', 'grey4.png'):
+            with self.subTest(name=name), Image.open(self.path(name)) as im:
+                self.assertIsNone(mediaResizer._band_reader(im))
+
+    def test_banded_thumbnail_matches_full_decode(self):
+        noise('RGB', (400, 300)).save(self.path('big.png'))
+        with Image.open(self.path('big.png')) as im:
+            banded = mediaResizer.banded_thumbnail(im, (100, 100), 200 * 1024)
+        with Image.open(self.path('big.png')) as im:
+            im = im.reduce(2)
+            im.thumbnail((100, 100), Image.Resampling.LANCZOS)
+        self.assertEqual(banded.size, im.size)
+        self.assertEqual(banded.tobytes(), im.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
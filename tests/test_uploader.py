@@ -0,0 +1,123 @@
+"""
+Runs the Uploader against a stand-in HTTP server on localhost.
+"""
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import mediaResizer  # noqa: E402
+
+
+class PutHandler(http.server.BaseHTTPRequestHandler):
+    "Stores PUT bodies under the server's root and answers HEAD for them."
+    failures = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _path(self):
+        return os.path.join(self.server.root, self.path.lstrip('/'))
+
+    def do_HEAD(self):
+        path = self._path()
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('ETag', f'"{mediaResizer.file_digest(path, "md5").hexdigest()}"')
+        self.end_headers()
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        os.makedirs(os.path.dirname(self._path()), exist_ok=True)
+        with open(self._path(), 'wb') as stored:
+            stored.write(body)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_MKCOL(self):
+        self.send_response(405)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class UploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.TemporaryDirectory()
+        self.remote = tempfile.TemporaryDirectory()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PutHandler)
+        self.server.root = self.remote.name
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/upload"
+        self.files = []
+        for name in ('a.JPG', 'b.JPG'):
+            path = os.path.join(self.local.name, 'resized_1920x1080', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output:
+                output.write(name.encode() * 1000)
+            self.files.append(path)
+        # No backoff waits in tests.
+        patcher = mock.patch.object(mediaResizer.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.local.cleanup()
+        self.remote.cleanup()
+
+    def upload(self, retries=3):
+        uploader = mediaResizer.Uploader(self.url, self.local.name, jobs=2, retries=retries)
+        for path in self.files:
+            uploader.submit(path)
+        uploader.close()
+        return uploader
+
+    def test_uploads_and_skips_what_is_there(self):
+        uploader = self.upload()
+        self.assertEqual((uploader.uploaded, uploader.skipped, uploader.failed), (2, 0, []))
+        for path in self.files:
+            remote = os.path.join(self.remote.name, 'upload', 'resized_1920x1080',
+                                  os.path.basename(path))
+            with open(remote, 'rb') as stored, open(path, 'rb') as original:
+                self.assertEqual(stored.read(), original.read())
+        uploader = self.upload()
+        self.assertEqual((uploader.uploaded, uploader.skipped), (0, 2))
+
+    def test_retries_server_errors(self):
+        self.server.failures = 2
+        uploader = self.upload(retries=3)
+        self.assertEqual((uploader.uploaded, uploader.failed), (2, []))
+
+    def test_counts_failures_once_retries_run_out(self):
+        self.server.failures = 100
+        uploader = self.upload(retries=2)
+        self.assertEqual(uploader.uploaded, 0)
+        self.assertEqual(sorted(uploader.failed), self.files)
+
+    @unittest.skipIf(mediaResizer.paramiko is None, 'paramiko is not installed')
+    def test_counts_ssh_failures(self):
+        error = mediaResizer.paramiko.AuthenticationException('denied')
+        with mock.patch.object(mediaResizer.Uploader, '_upload', side_effect=error):
+            uploader = self.upload(retries=2)
+        self.assertEqual(sorted(uploader.failed), self.files)
+
+
+if __name__ == '__main__':
+    unittest.main()